@@ -1,20 +1,235 @@
 # %%
-from aicsimageio import AICSImage
-from qtpy.QtWidgets import QListWidget
-from qtpy.QtCore import Qt, QFileInfo
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from napari.qt.threading import thread_worker
+from napari.utils import progress, resize_dask_cache
+from qtpy.QtWidgets import QTreeWidget, QTreeWidgetItem
+from qtpy.QtCore import Qt, QSize, Signal
+from qtpy.QtGui import QIcon, QImage, QPixmap
 import napari
 
+from napari_scripts_core import (
+    PlaneCache,
+    build_pyramid,
+    describe_scene,
+    latency,
+    load_scene,
+    neighbour_steps,
+    scene_index,
+    scene_pyramid,
+    scene_scale,
+    scene_thumbnail,
+    squeeze_dims,
+)
+from lif_to_zarr import open_zarr_scene
+
+
 # %%
-# Make a custom QListWidget that can accept drag and drop
-class SceneList(QListWidget):
+def load_scene_data(
+    img_file, entry, multiscale=False, persist_pyramid=False, chunk_dims="YX"
+):
+    """Data of a scene without its singleton axes, and the scale of each axis."""
+    scene = entry["name"]
+    # prefer an OME-Zarr copy made by lif_to_zarr.py. The copy is stitched,
+    # so for mosaics it is only used for pyramids, which are built from the
+    # stitched scene; otherwise the tiles are read from the LIF along M
+    data = None
+    tiles = dict(zip(entry["dims"], entry["shape"])).get("M", 1)
+    if multiscale or tiles == 1:
+        data = open_zarr_scene(img_file, scene, reconstruct_mosaic=True)
+    if data is not None:
+        dims = squeeze_dims("TCZYX", data.shape)
+        data = data[tuple(slice(None) if d in dims else 0 for d in "TCZYX")]
+        if multiscale:
+            data = build_pyramid(data)
+    else:
+        # otherwise read the LIF using AICSImage, each scene with its own
+        # reader, chunked by `chunk_dims` (one plane per chunk by default);
+        # recently opened scenes are cached
+        dims = squeeze_dims(entry["dims"], entry["shape"])
+        if multiscale:
+            # the tiles of a mosaic (M) are each only tile-sized, so the
+            # pyramid is built from the stitched scene
+            dims = dims.replace("M", "")
+            data = scene_pyramid(
+                img_file,
+                scene,
+                dims,
+                persist=persist_pyramid,
+                reconstruct_mosaic=True,
+                chunk_dims=chunk_dims,
+            )
+        else:
+            data = load_scene(
+                img_file, scene, dims, reconstruct_mosaic=False, chunk_dims=chunk_dims
+            )
+    return data, scene_scale(dims, entry["physical_pixel_sizes"])
+
+
+# %%
+class PlanePrefetcher:
+    """Read the planes around the current dims step of a layer in the background.
+
+    The layer data must be wrapped by `cache` (a `PlaneCache`): computing the
+    planes stores them there, and moving the slider then reads them from
+    memory. Requests for an older step that have not started yet are
+    cancelled. The cached planes are released when the layer is removed.
+    """
+
+    def __init__(self, viewer, layer, cache, n=2, pool=None):
+        self.viewer = viewer
+        self.layer = layer
+        self.cache = cache
+        self.n = n
+        self.pool = pool or ThreadPoolExecutor(max_workers=2)
+        self._futures = []
+        viewer.dims.events.current_step.connect(self.prefetch)
+        viewer.layers.events.removed.connect(self._on_removed)
+        self.prefetch()
+
+    def prefetch(self, event=None):
+        for future in self._futures:
+            future.cancel()
+        data = self.layer.data
+        # the current position in data coordinates of the layer (level)
+        coords = np.asarray(self.layer.world_to_data(self.viewer.dims.point))
+        if self.layer.multiscale:
+            data = data[self.layer.data_level]
+            coords = coords / self.layer.downsample_factors[self.layer.data_level]
+        step = np.clip(np.round(coords).astype(int), 0, np.array(data.shape) - 1)
+        # the sliders of the layer are the last axes of the viewer
+        offset = self.viewer.dims.ndim - data.ndim
+        axes = [a - offset for a in self.viewer.dims.not_displayed if a >= offset]
+        self._futures = [
+            self.pool.submit(self._read, data, idx)
+            for idx in neighbour_steps(
+                [int(step[a]) if a in axes else slice(None) for a in range(data.ndim)],
+                data.shape,
+                axes,
+                self.n,
+            )
+        ]
+
+    @staticmethod
+    def _read(data, idx):
+        data[idx].compute(scheduler="synchronous")
+
+    def _on_removed(self, event):
+        if event.value is self.layer:
+            for future in self._futures:
+                future.cancel()
+            levels = self.layer.data if self.layer.multiscale else [self.layer.data]
+            for level in levels:
+                self.cache.release(level)
+            self.viewer.dims.events.current_step.disconnect(self.prefetch)
+            self.viewer.layers.events.removed.disconnect(self._on_removed)
+
+
+# %%
+# Make a custom QTreeWidget that can accept drag and drop,
+# with the scenes of each LIF grouped under the file
+class SceneList(QTreeWidget):
+    # emitted from the worker threads, delivered on the GUI thread
+    file_indexed = Signal(str, object, object)
+    thumbnail_ready = Signal(str, str, object)
+
     # be able to pass the Napari viewer name (viewer)
-    def __init__(self, viewer, parent=None):
+    def __init__(
+        self,
+        viewer,
+        parent=None,
+        thumbnail_size=64,
+        thumbnail_workers=4,
+        index_workers=8,
+        multiscale=False,
+        persist_pyramid=False,
+        chunk_dims="YX",
+        cache_size=2**30,
+        prefetch=0,
+    ):
         super().__init__(parent)
         self.viewer = viewer
+        # optionally open scenes as multiscale pyramids, computed lazily or
+        # persisted once to a local Zarr cache
+        self.multiscale = multiscale
+        self.persist_pyramid = persist_pyramid
+        # scenes are read in chunks of `chunk_dims` (one display plane by
+        # default), recently viewed chunks are kept in a cache of `cache_size`
+        # bytes
+        self.chunk_dims = chunk_dims
+        resize_dask_cache(cache_size)
+        # optionally read the `prefetch` planes around the current one ahead,
+        # into a plane cache of `cache_size` bytes that the layers read through
+        self.prefetch = prefetch
+        self._prefetch_pool = ThreadPoolExecutor(max_workers=2)
+        self._plane_cache = PlaneCache(cache_size)
+        self.index = {}
+        self._opening = 0
+        self._files = {}
+        self._items = {}
+        self.setHeaderHidden(True)
         self.setAcceptDrops(True)
         self.setDragEnabled(True)
         self.currentItemChanged.connect(self.open_scene)
 
+        # dropped files are indexed concurrently
+        self._index_pool = ThreadPoolExecutor(max_workers=index_workers)
+        self.file_indexed.connect(self._add_file)
+
+        # thumbnails are made in a bounded thread pool, visible items first
+        self.thumbnail_size = thumbnail_size
+        self.setIconSize(QSize(thumbnail_size, thumbnail_size))
+        self._thumbnail_pool = ThreadPoolExecutor(max_workers=thumbnail_workers)
+        self._max_in_flight = thumbnail_workers
+        self._thumbnail_pending = []
+        # counted on the GUI thread: every thumbnail job ends in _set_thumbnail
+        self._thumbnails_in_flight = 0
+        self.thumbnail_ready.connect(self._set_thumbnail)
+        self.verticalScrollBar().valueChanged.connect(self._submit_thumbnails)
+
+    def _is_visible(self, key):
+        rect = self.visualItemRect(self._items[key])
+        return rect.intersects(self.viewport().rect())
+
+    def start_thumbnails(self, img_file, scenes):
+        self._thumbnail_pending.extend((img_file, scene) for scene in scenes)
+        self._submit_thumbnails()
+
+    def _submit_thumbnails(self):
+        while self._thumbnail_pending and (
+            self._thumbnails_in_flight < self._max_in_flight
+        ):
+            visible = [k for k in self._thumbnail_pending if self._is_visible(k)]
+            key = visible[0] if visible else self._thumbnail_pending[0]
+            self._thumbnail_pending.remove(key)
+            self._thumbnail_pool.submit(self._make_thumbnail, *key)
+            self._thumbnails_in_flight += 1
+
+    def _make_thumbnail(self, img_file, scene):
+        try:
+            thumbnail = scene_thumbnail(
+                img_file, scene, size=self.thumbnail_size, reconstruct_mosaic=False
+            )
+        except Exception as e:
+            print(f"No thumbnail for {scene}: {e}")
+            thumbnail = None
+        self.thumbnail_ready.emit(img_file, scene, thumbnail)
+
+    def _set_thumbnail(self, img_file, scene, thumbnail):
+        self._thumbnails_in_flight -= 1
+        # the file may have been dropped again in the meantime
+        item = self._items.get((img_file, scene))
+        if item is not None and thumbnail is not None:
+            height, width = thumbnail.shape
+            image = QImage(
+                thumbnail.data, width, height, width, QImage.Format_Grayscale8
+            ).copy()
+            item.setIcon(0, QIcon(QPixmap.fromImage(image)))
+        self._submit_thumbnails()
+
     def dragEnterEvent(self, event):
         if event.mimeData().hasUrls:
             event.accept()
@@ -31,84 +246,165 @@ class SceneList(QListWidget):
         if event.mimeData().hasUrls():
             event.setDropAction(Qt.CopyAction)
             event.accept()
-            # Check that it's a LIF file
+            # Check that it's a LIF file, folders are searched for LIFs
+            files = []
             for url in event.mimeData().urls():
-                img_file = str(url.toLocalFile())
-                info = QFileInfo(img_file)
-                if info.completeSuffix() == "lif":
-                    # Load data from LIF using AICSImage
-                    img = AICSImage(img_file, reconstruct_mosaic=False)
-                    # Make a list of the scenes
-                    for scene in img.scenes:
-                        self.addItem(scene)
-                    self.img = img
+                path = Path(url.toLocalFile())
+                if path.is_dir():
+                    files.extend(str(f) for f in sorted(path.glob("*.lif")))
+                elif path.suffix == ".lif":
+                    files.append(str(path))
                 else:
-                    print("Not a LIF")
-                    event.ignore()
+                    print(f"Not a LIF: {path.name}")
+            self.index_files(files)
         else:
             event.ignore()
 
+    def index_files(self, files):
+        if not files:
+            return
+        # Index the scenes from the metadata only (cached on disk), the LIF
+        # is only opened with AICSImage once a scene is opened
+        pbr = progress(total=len(files), desc="Reading LIF metadata")
+        for img_file in files:
+            self._index_pool.submit(self._index_file, img_file, pbr)
+
+    def _index_file(self, img_file, pbr):
+        try:
+            index = scene_index(img_file, reconstruct_mosaic=False)
+        except Exception as e:
+            index = e
+        self.file_indexed.emit(img_file, index, pbr)
+
+    def _add_file(self, img_file, index, pbr):
+        pbr.update(1)
+        if pbr.n >= pbr.total:
+            pbr.close()
+        if isinstance(index, Exception):
+            print(f"Could not read {img_file}: {index}")
+            return
+        self.remove_file(img_file)
+        # Make a list of the scenes under the file
+        file_item = QTreeWidgetItem(self, [Path(img_file).name])
+        file_item.setToolTip(0, img_file)
+        for entry in index:
+            item = QTreeWidgetItem(file_item, [describe_scene(entry)])
+            item.setData(0, Qt.UserRole, entry["name"])
+            item.setData(0, Qt.UserRole + 1, img_file)
+            self.index[img_file, entry["name"]] = entry
+            self._items[img_file, entry["name"]] = item
+        file_item.setExpanded(True)
+        self._files[img_file] = file_item
+        self.start_thumbnails(img_file, [entry["name"] for entry in index])
+
+    def remove_file(self, img_file):
+        file_item = self._files.pop(img_file, None)
+        if file_item is None:
+            return
+        self.takeTopLevelItem(self.indexOfTopLevelItem(file_item))
+        for key in [key for key in self._items if key[0] == img_file]:
+            del self._items[key], self.index[key]
+        self._thumbnail_pending = [
+            key for key in self._thumbnail_pending if key[0] != img_file
+        ]
+
     def open_scene(self):
         item = self.currentItem()
-        scene = item.text()
-        self.img.set_scene(scene)
-        if len(self.img.shape) == 6:
-            M = "M"
-            if self.img.shape[1] == 1:
-                C = ""
-            else:
-                C = "C"
-            if self.img.shape[2] == 1:
-                T = ""
-            else:
-                T = "T"
-            if self.img.shape[3] == 1:
-                Z = ""
-            else:
-                Z = "Z"
-        else:
-            M = ""
-            if self.img.shape[0] == 1:
-                C = ""
-            else:
-                C = "C"
-            if self.img.shape[1] == 1:
-                T = ""
-            else:
-                T = "T"
-            if self.img.shape[2] == 1:
-                Z = ""
-            else:
-                Z = "Z"
-        channels = M + C + T + Z + "YX"
-        if self.img.physical_pixel_sizes.Z is None:
-            scale = [
-                self.img.physical_pixel_sizes.Y,
-                self.img.physical_pixel_sizes.X,
-            ]
-        else:
-            scale = [
-                self.img.physical_pixel_sizes.Z,
-                self.img.physical_pixel_sizes.Y,
-                self.img.physical_pixel_sizes.X,
-            ]
+        # file items only group the scenes
+        if item is None or item.parent() is None:
+            return
+        scene = item.data(0, Qt.UserRole)
+        img_file = item.data(0, Qt.UserRole + 1)
+        entry = self.index[img_file, scene]
+        # for the latency record: scenes still loading when this one was opened
+        requested, queue = time.perf_counter(), self._opening
+        self._opening += 1
+
+        def load():
+            start = time.perf_counter()
+            data, scale = load_scene_data(
+                img_file,
+                entry,
+                multiscale=self.multiscale,
+                persist_pyramid=self.persist_pyramid,
+                chunk_dims=self.chunk_dims,
+            )
+            return data, scale, time.perf_counter() - start
+
+        def loaded(result):
+            data, scale, compute = result
+            start = time.perf_counter()
+            self.add_scene(data, scale, scene)
+            end = time.perf_counter()
+            latency.record(
+                "open_scene",
+                end - requested,
+                compute=compute,
+                draw=end - start,
+                queue=queue,
+            )
+
+        # Load data in a worker thread
+        worker = thread_worker(load, start_thread=False)()
+        worker.returned.connect(loaded)
+        worker.errored.connect(lambda e: print(f"Could not open {scene}: {e}"))
+        worker.finished.connect(self._scene_opened)
+        worker.start()
+
+    def _scene_opened(self):
+        self._opening -= 1
+
+    def add_scene(self, data, scale, scene):
         if self.viewer.theme == "light":
             colormap = "gray_r"
         else:
             colormap = "gray"
-        self.viewer.add_image(
-            self.img.get_image_dask_data(channels),
+        # a pyramid is a list of levels; single-level pyramids are plain data
+        if isinstance(data, list) and len(data) == 1:
+            data = data[0]
+        if self.prefetch:
+            # read through the plane cache (instead of napari's chunk cache),
+            # so that prefetched planes are there when they are displayed
+            if isinstance(data, list):
+                data = [self._plane_cache.wrap(level) for level in data]
+            else:
+                data = self._plane_cache.wrap(data)
+        layer = self.viewer.add_image(
+            data,
             name=scene,
             scale=scale,
             colormap=colormap,
+            multiscale=isinstance(data, list),
+            cache=not self.prefetch,
         )
         self.viewer.scale_bar.visible = True
+        if self.prefetch:
+            PlanePrefetcher(
+                self.viewer,
+                layer,
+                self._plane_cache,
+                self.prefetch,
+                self._prefetch_pool,
+            )
 
 
 # %%
-def lif_widget():
+def lif_widget(
+    multiscale=False,
+    persist_pyramid=False,
+    chunk_dims="YX",
+    cache_size=2**30,
+    prefetch=0,
+):
     viewer = napari.Viewer()
-    list_widget = SceneList(viewer)
+    list_widget = SceneList(
+        viewer,
+        multiscale=multiscale,
+        persist_pyramid=persist_pyramid,
+        chunk_dims=chunk_dims,
+        cache_size=cache_size,
+        prefetch=prefetch,
+    )
     viewer.window.add_dock_widget(list_widget, area="right", name="LIF Scene Browser")
     return viewer
 
@@ -0,0 +1,376 @@
+"""Benchmarks of the napari scripts on synthetic data, without a display.
+
+Run as:
+```
+python benchmarks.py                   # everything
+python benchmarks.py -k profile lut    # only benchmarks whose name matches
+python benchmarks.py --scale 0.5 --json before.json
+```
+For each benchmark the best time of a few repeats, the throughput and the
+peak memory (traced by `tracemalloc` in a separate run) are reported. The
+interactive callbacks are timed through the core functions they call:
+`update_profile` -> `profile_stack` and `ProfilePlot.update` (drawn with
+Agg), `measure_prop` -> `measure_shapes`,
+`_on_click_import_LUT` -> `read_lut` and `SceneList.open_scene` ->
+`scene_index` + `load_scene` + reading the first plane, the latter with a
+fake multi-scene reader in place of aicsimageio.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+from collections import namedtuple
+from pathlib import Path
+
+import numpy as np
+
+import napari_scripts_core as core
+
+BENCHMARKS = {}
+
+
+def benchmark(name, unit):
+    # register `setup(scale) -> (run, n)`; `run()` does `n` units of work
+    def register(setup):
+        BENCHMARKS[name] = (setup, unit)
+        return setup
+
+    return register
+
+
+def random_lines(rng, n, size):
+    return [rng.uniform(0, size - 1, (2, 2)) for _ in range(n)]
+
+
+def random_shapes(rng, n, shape_type, size):
+    centers = rng.uniform(0.1 * size, 0.9 * size, (n, 2))
+    radii = rng.uniform(5, 0.05 * size, (n, 1))
+    if shape_type == "line":
+        return [c + r * rng.uniform(-1, 1, (2, 2)) for c, r in zip(centers, radii)]
+    if shape_type in ("rectangle", "ellipse"):
+        corners = np.array([[-1, -1], [-1, 1], [1, 1], [1, -1]])
+        return [c + r * corners for c, r in zip(centers, radii)]
+    # paths and polygons with 3-20 vertices
+    shapes = []
+    for c, r in zip(centers, radii):
+        angles = np.sort(rng.uniform(0, 2 * np.pi, rng.integers(3, 21)))
+        shapes.append(c + r * np.stack([np.sin(angles), np.cos(angles)], axis=1))
+    return shapes
+
+
+# %% line profiles
+@benchmark("profile 2D numpy", "lines")
+def _(scale):
+    rng = np.random.default_rng(0)
+    size = int(2048 * scale)
+    image = rng.integers(0, 4096, (size, size), dtype=np.uint16)
+    lines = random_lines(rng, 50, size)
+    return lambda: [core.profile_stack(image, *line) for line in lines], len(lines)
+
+
+@benchmark("profile 3D numpy, linewidth 5", "lines")
+def _(scale):
+    rng = np.random.default_rng(0)
+    size = int(1024 * scale)
+    stack = rng.integers(0, 4096, (20, size, size), dtype=np.uint16)
+    lines = random_lines(rng, 10, size)
+    return (
+        lambda: [core.profile_stack(stack, *line, linewidth=5) for line in lines],
+        len(lines),
+    )
+
+
+@benchmark("profile 3D dask", "lines")
+def _(scale):
+    import dask.array as da
+
+    rng = np.random.default_rng(0)
+    size = int(1024 * scale)
+    stack = da.random.RandomState(0).randint(
+        0, 4096, (20, size, size), chunks=(1, size, size), dtype=np.uint16
+    )
+    lines = random_lines(rng, 10, size)
+    return lambda: [core.profile_stack(stack, *line) for line in lines], len(lines)
+
+
+@benchmark("profile plot update (Agg)", "updates")
+def _(scale):
+    import matplotlib
+
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    from napari_line_profile_widget import ProfilePlot
+
+    rng = np.random.default_rng(0)
+    fig, ax = plt.subplots()
+    plot = ProfilePlot(ax)
+    x = np.arange(int(1000 * scale))
+    profiles = [
+        {f"C{c} (line 1)": (x, rng.uniform(90, 100, x.size)) for c in range(4)}
+        for _ in range(20)
+    ]
+    fig.canvas.draw()
+
+    def run():
+        for p in profiles:
+            plot.update(p)
+
+    return run, len(profiles)
+
+
+# %% shape measurements, one benchmark per shape type
+def _measure(shape_type, intensity):
+    def setup(scale):
+        rng = np.random.default_rng(0)
+        size = int(2048 * scale)
+        n = int(2000 * scale)
+        shapes = random_shapes(rng, n, shape_type, size)
+        image = None
+        if intensity:
+            image = rng.integers(0, 4096, (size, size), dtype=np.uint16)
+        px_size = np.array([0.1, 0.1])
+        return (
+            lambda: core.measure_shapes(
+                shapes, [shape_type] * n, px_size, "µm", image=image
+            ),
+            n,
+        )
+
+    return setup
+
+
+for shape_type in core.SHAPE_NAMES:
+    benchmark(f"measure {shape_type}s", "shapes")(_measure(shape_type, False))
+    benchmark(f"measure {shape_type}s with intensity", "shapes")(
+        _measure(shape_type, True)
+    )
+
+
+@benchmark("measurement cache, edit one shape", "updates")
+def _(scale):
+    rng = np.random.default_rng(0)
+    n = int(2000 * scale)
+    shapes = random_shapes(rng, n, "polygon", 2048)
+    cache = core.MeasurementCache(np.array([0.1, 0.1]), "µm", None)
+    cache.update(shapes, ["polygon"] * n)
+
+    def run():
+        for i in range(0, n, n // 10):
+            shapes[i] = shapes[i] + 1
+            cache.update(shapes, ["polygon"] * n)
+
+    return run, 10
+
+
+@benchmark("shape index, neighbours and overlaps", "shapes")
+def _(scale):
+    rng = np.random.default_rng(0)
+    n = int(5000 * scale)
+    shapes = random_shapes(rng, n, "polygon", int(8192 * scale))
+    index = core.ShapeIndex(np.array([0.1, 0.1]), 10.0, "µm")
+    index.update(0, 0, shapes)
+    return index.neighbours, n
+
+
+# %% ImageJ LUTs
+def _write_luts(folder, n):
+    rng = np.random.default_rng(0)
+    for i in range(n):
+        rgb = rng.integers(0, 256, (256, 3), dtype=np.uint8)
+        if i % 2:
+            rgb.T.tofile(folder / f"binary{i}.lut")
+        else:
+            index = np.arange(256)[:, None]
+            np.savetxt(
+                folder / f"ascii{i}.lut",
+                np.hstack([index, rgb]),
+                fmt="%d",
+                delimiter="\t",
+                header="Index\tRed\tGreen\tBlue",
+                comments="",
+            )
+
+
+@benchmark("read_lut ascii and binary", "files")
+def _(scale):
+    folder = Path(tempfile.mkdtemp())
+    _write_luts(folder, 100)
+    paths = sorted(folder.glob("*.lut"))
+    return lambda: [core.read_lut(path) for path in paths], len(paths)
+
+
+@benchmark("lut_library, cold cache", "files")
+def _(scale):
+    folder = Path(tempfile.mkdtemp())
+    n = int(300 * scale)
+    _write_luts(folder, n)
+    return lambda: core.lut_library(folder, cache_dir=tempfile.mkdtemp()), n
+
+
+@benchmark("lut_library, warm cache", "files")
+def _(scale):
+    folder = Path(tempfile.mkdtemp())
+    cache_dir = tempfile.mkdtemp()
+    n = int(300 * scale)
+    _write_luts(folder, n)
+    core.lut_library(folder, cache_dir=cache_dir)
+    return lambda: core.lut_library(folder, cache_dir=cache_dir), n
+
+
+# %% LIF scenes, with a fake multi-scene reader
+PhysicalPixelSizes = namedtuple("PhysicalPixelSizes", "Z Y X")
+
+
+class FakeAICSImage:
+    """Stands in for aicsimageio.AICSImage: scenes of random MTCZYX data.
+
+    Each scene is a mosaic of `tiles` (rows, columns) tiles of `scene_shape`,
+    stitched unless `reconstruct_mosaic=False`, which keeps them along M.
+    """
+
+    scene_shape = (1, 3, 2, 20, 1024, 1024)
+    tiles = (1, 1)
+
+    def __init__(self, path, reconstruct_mosaic=True, **kwargs):
+        self.reconstruct_mosaic = reconstruct_mosaic
+        self.scenes = tuple(f"Position {i}" for i in range(20))
+        self.current_scene = self.scenes[0]
+        self.dims = types.SimpleNamespace(order="MTCZYX")
+        self.dtype = np.dtype(np.uint16)
+        self.physical_pixel_sizes = PhysicalPixelSizes(0.5, 0.1, 0.1)
+        self.channel_names = ["DAPI", "GFP"]
+
+    @property
+    def shape(self):
+        m, t, c, z, y, x = self.scene_shape
+        rows, columns = self.tiles
+        if self.reconstruct_mosaic:
+            return (m, t, c, z, y * rows, x * columns)
+        return (m * rows * columns, t, c, z, y, x)
+
+    def set_scene(self, scene):
+        self.current_scene = scene
+
+    def get_image_dask_data(self, dims="TCZYX", **kwargs):
+        import dask.array as da
+
+        chunks = (1,) * 4 + self.shape[-2:]
+        data = da.random.RandomState(0).randint(
+            0, 4096, self.shape, chunks=chunks, dtype=np.uint16
+        )
+        index = tuple(
+            kwargs.get(d, slice(None) if d in dims else 0) for d in self.dims.order
+        )
+        kept = [d for d in self.dims.order if d in dims and d not in kwargs]
+        data = data[index]
+        for d in dims:
+            if d not in kept:
+                data, kept = data[None], [d, *kept]
+        return data.transpose([kept.index(d) for d in dims])
+
+
+@benchmark("open_scene, fake LIF", "scenes")
+def _(scale):
+    FakeAICSImage.scene_shape = (1, 3, 2, 20, int(1024 * scale), int(1024 * scale))
+    FakeAICSImage.tiles = (1, 1)
+    sys.modules["aicsimageio"] = types.SimpleNamespace(AICSImage=FakeAICSImage)
+    path = Path(tempfile.mkdtemp()) / "fake.lif"
+    path.write_bytes(b"")
+    cache_dir = tempfile.mkdtemp()
+    n = 0
+
+    def run():
+        # a new mtime defeats the scene cache, so every scene is read anew
+        nonlocal n
+        n += 1
+        path.write_bytes(b"\0" * n)
+        for entry in core.scene_index(path, cache_dir=cache_dir):
+            dims = core.squeeze_dims(entry["dims"], entry["shape"])
+            data = core.load_scene(path, entry["name"], dims)
+            np.asarray(data[(0,) * (data.ndim - 2)])
+
+    return run, 20
+
+
+@benchmark("open_scene multiscale, fake 4x4 mosaic", "scenes")
+def _(scale):
+    tile = int(1024 * scale)
+    FakeAICSImage.scene_shape = (1, 1, 1, 5, tile, tile)
+    FakeAICSImage.tiles = (4, 4)
+    sys.modules["aicsimageio"] = types.SimpleNamespace(AICSImage=FakeAICSImage)
+    path = Path(tempfile.mkdtemp()) / "mosaic.lif"
+    path.write_bytes(b"")
+    cache_dir = tempfile.mkdtemp()
+    # listed with the tiles along M, opened stitched (as the LIF browser does)
+    entries = core.scene_index(path, cache_dir=cache_dir, reconstruct_mosaic=False)
+    entry = entries[0]
+    dims = core.squeeze_dims(entry["dims"], entry["shape"]).replace("M", "")
+    levels = core.scene_pyramid(
+        path,
+        entry["name"],
+        dims,
+        min_size=tile,
+        reconstruct_mosaic=True,
+        chunk_dims="YX",
+    )
+    # a single tile fits in one level, only the stitched scene is pyramided
+    assert len(levels) > 1, "the mosaic was not stitched before the pyramid"
+
+    def run():
+        for level in levels:
+            np.asarray(level[(0,) * (level.ndim - 2)])
+
+    return run, 1
+
+
+# %%
+def run_benchmark(setup, scale, repeat):
+    run, n = setup(scale)
+    run()  # warm up caches and imports
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {"seconds": best, "n": n, "per_second": n / best, "peak_mb": peak / 1e6}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-k", nargs="+", help="only run benchmarks matching these")
+    parser.add_argument(
+        "--scale", type=float, default=1.0, help="scale of the synthetic data"
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args(argv)
+
+    results = {}
+    print(f"{'benchmark':<44}{'time':>10}{'throughput':>22}{'peak memory':>14}")
+    for name, (setup, unit) in BENCHMARKS.items():
+        if args.k and not any(k in name for k in args.k):
+            continue
+        result = run_benchmark(setup, args.scale, args.repeat)
+        results[name] = {**result, "unit": unit}
+        print(
+            f"{name:<44}{result['seconds'] * 1000:>8.1f}ms"
+            f"{result['per_second']:>14.1f} {unit + '/s':<9}"
+            f"{result['peak_mb']:>10.1f} MB"
+        )
+    if args.json:
+        Path(args.json).write_text(json.dumps({"scale": args.scale, **results}))
+
+
+if __name__ == "__main__":
+    main()
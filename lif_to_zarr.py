@@ -0,0 +1,263 @@
+"""Convert the scenes of LIF files to OME-Zarr.
+
+Can be used from Python:
+```
+import lif_to_zarr
+lif_to_zarr.convert_lif("experiment.lif", workers=8)
+```
+or from the command line:
+```
+python lif_to_zarr.py experiment.lif other.lif --workers 8 --processes
+```
+Each file is written to `<file>.ome.zarr` (or into `--out`), with one OME-NGFF
+(v0.4) image group per scene. Data are streamed block by block, the progress
+of every scene is recorded plane by plane, so an interrupted conversion resumes where it
+stopped, and the LIF Scene Browser opens the Zarr copy when it exists.
+Mosaics are stored stitched (OME-NGFF has no axis for the tiles).
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from pathlib import Path
+
+import numpy as np
+
+from napari_scripts_core import load_scene, scene_index
+
+DIMS = "TCZYX"
+AXES = [
+    {"name": "t", "type": "time"},
+    {"name": "c", "type": "channel"},
+    {"name": "z", "type": "space", "unit": "micrometer"},
+    {"name": "y", "type": "space", "unit": "micrometer"},
+    {"name": "x", "type": "space", "unit": "micrometer"},
+]
+# the tiles of mosaics are stitched, recorded in the root attributes
+READER_KWARGS = {"reconstruct_mosaic": True, "chunk_dims": "YX"}
+
+
+def _zarr_format():
+    # OME-NGFF v0.4 is stored as Zarr v2
+    import zarr
+
+    return {"zarr_format": 2} if int(zarr.__version__.split(".")[0]) >= 3 else {}
+
+
+def zarr_path(path: str | Path, out: str | Path | None = None) -> Path:
+    """Location of the OME-Zarr copy of `path` (next to it, or in `out`)."""
+    path = Path(path)
+    return Path(out or path.parent) / f"{path.stem}.ome.zarr"
+
+
+def open_zarr_scene(
+    path: str | Path,
+    scene: str,
+    out: str | Path | None = None,
+    reconstruct_mosaic: bool = True,
+):
+    """Lazy TCZYX dask array of a completely converted scene, or None.
+
+    None is also returned if the copy was not read from the LIF with the
+    same `reconstruct_mosaic` (copies without the attribute were stitched).
+    """
+    import dask.array as da
+    import zarr
+
+    store = zarr_path(path, out)
+    if not store.exists():
+        return None
+    root = zarr.open_group(str(store), mode="r")
+    if root.attrs.get("reconstruct_mosaic", True) != reconstruct_mosaic:
+        return None
+    scenes = root.attrs.get("scenes", [])
+    if scene not in scenes or str(scenes.index(scene)) not in root:
+        return None
+    index = scenes.index(scene)
+    if not root[str(index)].attrs.get("complete"):
+        return None
+    return da.from_zarr(str(store), component=f"{index}/0")
+
+
+def _block_shape(shape, itemsize, block_bytes):
+    # whole-width YX tiles of one T/C/Z plane that fit in `block_bytes`
+    height, width = shape[-2:]
+    rows = int(np.clip(block_bytes // max(width * itemsize, 1), 1, height))
+    return (1,) * (len(shape) - 2) + (rows, width)
+
+
+def _convert_plane(path, scene, store, component, plane):
+    # runs in a worker thread or process; readers are cached per worker.
+    # The LIF is read one whole YX plane per chunk, so each plane is read
+    # once and written as all of its tiles
+    import zarr
+
+    data = load_scene(path, scene, DIMS, **READER_KWARGS)[plane]
+    zarr.open_array(str(store), path=component, mode="r+")[plane] = data.compute(
+        scheduler="synchronous"
+    )
+
+
+def convert_scene(
+    path: str | Path,
+    scene: str,
+    store: str | Path,
+    index: int,
+    entry: dict,
+    executor,
+    max_in_flight: int,
+    memory_budget: int,
+) -> None:
+    import zarr
+
+    component = f"{index}/0"
+    group = zarr.open_group(str(store), path=str(index), mode="a", **_zarr_format())
+    if group.attrs.get("complete"):
+        return
+    data = load_scene(path, scene, DIMS, **READER_KWARGS)
+    chunks = _block_shape(
+        data.shape, data.dtype.itemsize, memory_budget // max_in_flight
+    )
+    # whole planes are in flight, as many as fit in the budget (at least one)
+    plane_bytes = data.shape[-2] * data.shape[-1] * data.dtype.itemsize
+    max_in_flight = int(np.clip(memory_budget // plane_bytes, 1, max_in_flight))
+    progress_file = Path(store) / str(index) / "progress.txt"
+    if "0" in group and progress_file.exists():
+        done = set(progress_file.read_text().split())
+    else:
+        zarr.open_array(
+            str(store),
+            path=component,
+            mode="w",
+            shape=data.shape,
+            chunks=chunks,
+            dtype=data.dtype,
+            **_zarr_format(),
+        )
+        done = set()
+
+    in_flight = {}
+    with open(progress_file, "a") as progress:
+
+        def collect(futures):
+            for future in futures:
+                future.result()
+                progress.write(in_flight.pop(future) + "\n")
+            progress.flush()
+
+        for plane in np.ndindex(*data.shape[:-2]):
+            key = ",".join(map(str, plane))
+            if key in done:
+                continue
+            future = executor.submit(
+                _convert_plane, str(path), scene, str(store), component, plane
+            )
+            in_flight[future] = key
+            # bound the number of planes held in memory at once
+            if len(in_flight) >= max_in_flight:
+                collect(wait(in_flight, return_when=FIRST_COMPLETED).done)
+        collect(wait(in_flight).done)
+
+    size_Z, size_Y, size_X = entry["physical_pixel_sizes"]
+    group.attrs["multiscales"] = [
+        {
+            "version": "0.4",
+            "name": scene,
+            "axes": AXES,
+            "datasets": [
+                {
+                    "path": "0",
+                    "coordinateTransformations": [
+                        {"type": "scale", "scale": [1, 1, size_Z or 1, size_Y, size_X]}
+                    ],
+                }
+            ],
+        }
+    ]
+    group.attrs["omero"] = {
+        "channels": [{"label": name} for name in entry["channel_names"]]
+    }
+    group.attrs["complete"] = True
+    progress_file.unlink()
+
+
+def convert_lif(
+    path: str | Path,
+    out: str | Path | None = None,
+    scenes: list[str] | None = None,
+    workers: int = 4,
+    processes: bool = False,
+    memory_budget: int = 1024**3,
+) -> Path:
+    """Convert all (or the selected) scenes of a LIF file to OME-Zarr.
+
+    Planes are read and written by `workers` threads (or processes), with at
+    most `2 * workers` planes in flight, and no more than fit together in
+    `memory_budget` bytes (but always at least one). The Zarr chunks are
+    tiles of the planes sized for `2 * workers` of them to fit in the budget.
+    Returns the path of the Zarr store.
+    """
+    import zarr
+
+    index = scene_index(path, reconstruct_mosaic=READER_KWARGS["reconstruct_mosaic"])
+    names = [entry["name"] for entry in index]
+    store = zarr_path(path, out)
+    root = zarr.open_group(str(store), mode="a", **_zarr_format())
+    root.attrs["scenes"] = names
+    root.attrs["reconstruct_mosaic"] = READER_KWARGS["reconstruct_mosaic"]
+    max_in_flight = 2 * workers
+    pool = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    with pool(max_workers=workers) as executor:
+        for i, entry in enumerate(index):
+            if scenes is None or entry["name"] in scenes:
+                print(f"{Path(path).name}: {entry['name']}")
+                convert_scene(
+                    path,
+                    entry["name"],
+                    store,
+                    i,
+                    entry,
+                    executor,
+                    max_in_flight,
+                    memory_budget,
+                )
+    return store
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert LIF scenes to OME-Zarr.")
+    parser.add_argument("files", nargs="+", help="LIF files to convert")
+    parser.add_argument("--out", help="output folder (default: next to each file)")
+    parser.add_argument("--scenes", nargs="+", help="only convert these scenes")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument(
+        "--processes", action="store_true", help="use processes instead of threads"
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=float,
+        default=1.0,
+        help="GB of planes held in memory at once",
+    )
+    args = parser.parse_args(argv)
+    for path in args.files:
+        store = convert_lif(
+            path,
+            out=args.out,
+            scenes=args.scenes,
+            workers=args.workers,
+            processes=args.processes,
+            memory_budget=int(args.memory_budget * 1024**3),
+        )
+        print(json.dumps({"file": str(path), "zarr": str(store)}))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+"""Measure saved shape annotations on many images, without a viewer.
+
+Can be used from Python:
+```
+import measure_batch
+table = measure_batch.measure_images("images/", px_size=(0.1, 0.1), units="µm")
+```
+or from the command line:
+```
+python measure_batch.py images/ --pattern "*.tif" --pixel-size 0.1 0.1 --units µm --out results.csv
+```
+Every image is paired with the shapes saved next to it (or in `--shapes`)
+under the same name, as a napari shapes CSV or as GeoJSON, and measured like
+`measure_prop` does (length, angle, area and intensities). Images are spread
+over a pool of processes and read memory-mapped (.npy, uncompressed TIFF) or
+lazily with dask (.zarr, other TIFFs), so only the pixels under the shapes
+are loaded. All results are written to one table (.csv or .parquet).
+"""
+
+from __future__ import annotations
+
+import argparse
+import csv
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from napari_scripts_core import ResultStore, measure_shapes
+
+SHAPES_SUFFIXES = (".csv", ".geojson", ".json")
+
+
+def read_napari_csv(path: str | Path) -> tuple[list[np.ndarray], list[str]]:
+    """Shapes saved by napari as CSV (index, shape-type, vertex-index, axis-0, ...)."""
+    vertices, shape_types = {}, {}
+    with open(path, newline="") as f:
+        for row in csv.DictReader(f):
+            index = int(row["index"])
+            shape_types[index] = row["shape-type"]
+            coords = [float(v) for k, v in row.items() if k.startswith("axis-")]
+            vertices.setdefault(index, []).append(coords)
+    return [np.array(vertices[i]) for i in vertices], list(shape_types.values())
+
+
+def read_geojson(path: str | Path) -> tuple[list[np.ndarray], list[str]]:
+    """Shapes from the LineString and Polygon features of a GeoJSON file.
+
+    GeoJSON coordinates are (x, y); they are flipped to napari's (y, x). The
+    shape type is taken from a "shape_type" property if present, otherwise
+    LineStrings are lines (2 points) or paths and Polygons are polygons.
+    """
+    data = json.loads(Path(path).read_text())
+    features = data["features"] if "features" in data else [data]
+    vertices, shape_types = [], []
+    for feature in features:
+        geometry = feature["geometry"]
+        shape_type = (feature.get("properties") or {}).get("shape_type")
+        if geometry["type"] == "LineString":
+            lines = [geometry["coordinates"]]
+        elif geometry["type"] == "Polygon":
+            lines = [geometry["coordinates"][0]]
+        elif geometry["type"] == "MultiPolygon":
+            lines = [polygon[0] for polygon in geometry["coordinates"]]
+        else:
+            continue
+        for line in lines:
+            line = np.array(line, dtype=float)[:, 1::-1]
+            if geometry["type"] == "LineString":
+                default = "line" if len(line) == 2 else "path"
+            else:
+                default = "polygon"
+                # polygon rings repeat their first vertex at the end
+                if len(line) > 1 and np.array_equal(line[0], line[-1]):
+                    line = line[:-1]
+            vertices.append(line)
+            shape_types.append(shape_type or default)
+    return vertices, shape_types
+
+
+def read_shapes(path: str | Path) -> tuple[list[np.ndarray], list[str]]:
+    """Vertices and shape types from a napari shapes CSV or a GeoJSON file."""
+    if Path(path).suffix == ".csv":
+        return read_napari_csv(path)
+    return read_geojson(path)
+
+
+def open_image(path: str | Path):
+    """Memory-mapped or lazy (dask) image data; nothing is read yet."""
+    path = Path(path)
+    if path.suffix == ".npy":
+        return np.load(path, mmap_mode="r")
+    if path.suffix == ".zarr":
+        import dask.array as da
+
+        return da.from_zarr(str(path))
+    if path.suffix in (".tif", ".tiff"):
+        import tifffile
+
+        try:
+            return tifffile.memmap(path, mode="r")
+        except ValueError:
+            # compressed or tiled TIFFs are read chunk by chunk instead
+            import dask.array as da
+            import zarr
+
+            return da.from_zarr(zarr.open(tifffile.imread(path, aszarr=True), mode="r"))
+    raise ValueError(f"Unsupported image format: {path.name}")
+
+
+def find_shapes(image: Path, shapes_dir: Path | None = None) -> Path | None:
+    folder = shapes_dir or image.parent
+    # "cells.ome.tif" may be annotated as "cells.ome.csv" or "cells.csv"
+    for stem in dict.fromkeys([image.stem, image.name.split(".")[0]]):
+        for suffix in SHAPES_SUFFIXES:
+            if (folder / (stem + suffix)).exists():
+                return folder / (stem + suffix)
+    return None
+
+
+def measure_image(image_path, shapes_path, px_size, units="px", intensity=True):
+    """Measurements of the shapes in `shapes_path` on one image."""
+    data, shape_types = read_shapes(shapes_path)
+    image = open_image(image_path) if intensity else None
+    if image is not None and hasattr(image, "dask"):
+        import dask
+
+        # one image per process already uses all the cores
+        with dask.config.set(scheduler="synchronous"):
+            return measure_shapes(data, shape_types, px_size, units, image)
+    return measure_shapes(data, shape_types, px_size, units, image)
+
+
+def measure_images(
+    images,
+    shapes_dir: str | Path | None = None,
+    pattern: str = "*",
+    px_size=(1.0, 1.0),
+    units: str = "px",
+    intensity: bool = True,
+    workers: int | None = None,
+    out: str | Path | None = None,
+) -> ResultStore:
+    """Measure the saved shapes of many images in a process pool.
+
+    `images` is a folder (searched with `pattern`) or a list of image files.
+    Images without a shapes file are skipped. Returns one table with an
+    "Image" column, also written to `out` (.csv or .parquet) if given.
+    """
+    if isinstance(images, (str, Path)):
+        images = (
+            sorted(Path(images).glob(pattern)) if Path(images).is_dir() else [images]
+        )
+    shapes_dir = Path(shapes_dir) if shapes_dir is not None else None
+    jobs = []
+    for image in map(Path, images):
+        if image.suffix in SHAPES_SUFFIXES:
+            continue
+        shapes = find_shapes(image, shapes_dir)
+        if shapes is None:
+            print(f"No shapes for {image.name}, skipped")
+        else:
+            jobs.append((image, shapes))
+
+    image = np.zeros((1, 1)) if intensity else None
+    columns = list(measure_shapes([], [], px_size, units, image))
+    results = ResultStore(["Image"] + columns)
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        futures = [
+            executor.submit(measure_image, image, shapes, px_size, units, intensity)
+            for image, shapes in jobs
+        ]
+        # collected in order, so the rows follow the order of the images
+        for (image, _), future in zip(jobs, futures):
+            # one bad image or shapes file is reported and skipped, so the
+            # rest of the batch is not lost
+            try:
+                table = future.result()
+            except Exception as e:
+                print(f"Could not measure {image.name}: {e!r}")
+                continue
+            n = len(table["Shape"])
+            results.extend({"Image": np.full(n, image.name), **table})
+    if out is not None:
+        results.export(out)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Measure saved napari shapes on many images."
+    )
+    parser.add_argument("images", nargs="+", help="image files or a folder")
+    parser.add_argument("--pattern", default="*", help="images to use in a folder")
+    parser.add_argument("--shapes", help="folder of the shapes (default: images)")
+    parser.add_argument(
+        "--pixel-size", type=float, nargs=2, default=(1.0, 1.0), metavar=("Y", "X")
+    )
+    parser.add_argument("--units", default="px")
+    parser.add_argument(
+        "--no-intensity", action="store_true", help="only measure geometry"
+    )
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--out", default="measurements.csv")
+    args = parser.parse_args(argv)
+    results = measure_images(
+        args.images[0] if len(args.images) == 1 else args.images,
+        shapes_dir=args.shapes,
+        pattern=args.pattern,
+        px_size=args.pixel_size,
+        units=args.units,
+        intensity=not args.no_intensity,
+        workers=args.workers,
+        out=args.out,
+    )
+    print(f"{len(results)} shapes measured, written to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
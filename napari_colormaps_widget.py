@@ -1,8 +1,10 @@
 # %%
 import napari
 import numpy as np
+from fnmatch import fnmatch
 from pathlib import Path
 from qtpy.QtWidgets import (
+    QComboBox,
     QFileDialog,
     QVBoxLayout,
     QWidget,
@@ -13,8 +15,8 @@ from qtpy.QtWidgets import (
     QPushButton,
     QLineEdit,
 )
-from qtpy.QtCore import Qt
-from napari._qt.layer_controls.qt_colormap_combobox import QtColormapComboBox
+from qtpy.QtCore import Qt, QSize
+from qtpy.QtGui import QIcon, QImage, QPixmap
 from vispy.color import Colormap
 from napari.utils.colormaps import Colormap as NpColormap
 from napari.utils.colormaps.colormap_utils import (
@@ -22,7 +24,8 @@ from napari.utils.colormaps.colormap_utils import (
     ensure_colormap,
 )
 from magicgui.widgets import create_widget
-from skimage import data
+
+from napari_scripts_core import lut_library, read_lut
 
 # %%
 # These are vispy implementations of the inverted LUTs by @cleterrier from:
@@ -42,9 +45,33 @@ NapariColormaps = {
     name: ensure_colormap(convert_vispy_colormap(colormap, name=name))
     for name, colormap in ColormapDict.items()
 }
-# %%
-viewer = napari.Viewer()
-viewer.add_image(data.cells3d()[:, 1, :])
+
+# napari colormaps by name and control points, converted once
+_colormap_cache = {}
+# preview swatches of the colormaps in the LUT list, rendered once
+_swatch_cache = {}
+
+
+def cached_colormap(colors, name):
+    colors = np.asarray(colors, dtype=np.float32)
+    key = (name, colors.shape, colors.tobytes())
+    if key not in _colormap_cache:
+        _colormap_cache[key] = NpColormap(colors, name=name, display_name=name)
+    return _colormap_cache[key]
+
+
+def colormap_swatch(colormap, width=64, height=12):
+    key = (colormap.name, colormap.colors.tobytes(), colormap.controls.tobytes())
+    if key not in _swatch_cache:
+        rgba = colormap.map(np.linspace(0, 1, width))
+        strip = np.ascontiguousarray(
+            np.broadcast_to((rgba * 255).astype(np.uint8), (height, width, 4))
+        )
+        image = QImage(strip.data, width, height, 4 * width, QImage.Format_RGBA8888)
+        _swatch_cache[key] = QIcon(QPixmap.fromImage(image.copy()))
+    return _swatch_cache[key]
+
+
 # %%
 class CustomWidget(QWidget):
     def __init__(self) -> None:
@@ -52,6 +79,12 @@ class CustomWidget(QWidget):
         self.viewer = napari.current_viewer()
         self.main_layout = QVBoxLayout()
         self.setLayout(self.main_layout)
+        # colormaps are applied to all selected layers, or to all layers whose
+        # name matches the pattern (e.g. "*C1*"), if one is given
+        self.main_layout.addWidget(QLabel("Apply to layers matching:"))
+        self.layer_pattern = QLineEdit()
+        self.layer_pattern.setPlaceholderText("selected layers")
+        self.main_layout.addWidget(self.layer_pattern)
         self.tabs = QTabWidget()
         self.main_layout.addWidget(self.tabs)
 
@@ -61,18 +94,19 @@ class CustomWidget(QWidget):
         self.apply_colormap.setLayout(self._apply_colormap_layout)
         self.tabs.addTab(self.apply_colormap, "Apply cleterrier inverted LUTs")
 
-        colormap_choices = QtColormapComboBox(self)
+        # a plain combo box: each item only shows its cached swatch, rather
+        # than napari's colormap delegate rendering a colorbar on every paint
+        colormap_choices = QComboBox(self)
         colormap_choices.setObjectName("colormapComboBox")
-        colormap_choices._allitems = set(NapariColormaps)
+        colormap_choices.setIconSize(QSize(64, 12))
+        self.colormapComboBox = colormap_choices
+        self._colormap_names = set()
         for name, colormap in NapariColormaps.items():
-            colormap_choices.addItem(name, colormap)
+            self._add_colormap_choice(name, colormap)
 
         def set_lut():
-            self.viewer.layers.selection.active.colormap = (
-                colormap_choices.currentData()
-            )
+            self.apply(colormap_choices.currentData())
 
-        self.colormapComboBox = colormap_choices
         colormap_choices.currentTextChanged.connect(set_lut)
         self._apply_colormap_layout.addWidget(self.colormapComboBox)
         self._apply_colormap_layout.setAlignment(Qt.AlignTop)
@@ -114,13 +148,39 @@ class CustomWidget(QWidget):
         self.import_LUT_button = QPushButton("Select LUT to import and apply")
         self._import_LUT_layout.addWidget(self.import_LUT_button)
         self.import_LUT_button.clicked.connect(self._on_click_import_LUT)
+        # a whole folder of LUTs (e.g. Fiji's luts) is added to the LUT list
+        # of the first tab; parsed LUTs are cached, so re-imports are instant
+        self.import_LUT_folder_button = QPushButton("Select folder of LUTs to add")
+        self._import_LUT_layout.addWidget(self.import_LUT_folder_button)
+        self.import_LUT_folder_button.clicked.connect(self._on_click_import_LUT_folder)
+        self._import_LUT_layout.setAlignment(Qt.AlignTop)
+
+    def target_layers(self):
+        pattern = self.layer_pattern.text()
+        if pattern:
+            layers = [
+                layer for layer in self.viewer.layers if fnmatch(layer.name, pattern)
+            ]
+        else:
+            layers = list(self.viewer.layers.selection)
+        return [layer for layer in layers if isinstance(layer, napari.layers.Image)]
+
+    def apply(self, colormap):
+        for layer in self.target_layers():
+            layer.colormap = colormap
+
+    def _add_colormap_choice(self, name, colormap):
+        if name in self._colormap_names:
+            return
+        self.colormapComboBox.addItem(colormap_swatch(colormap), name, colormap)
+        self._colormap_names.add(name)
 
     def _apply_own_colormap(self):
         if self.inverted_colormap.isChecked():
             start = [1, 1, 1]
         else:
             start = [0, 0, 0]
-        own_colormap = Colormap(
+        own_colormap = cached_colormap(
             [
                 start,
                 [
@@ -128,52 +188,43 @@ class CustomWidget(QWidget):
                     self.G_value.value() / 255,
                     self.B_value.value() / 255,
                 ],
-            ]
-        )
-        self.viewer.layers.selection.active.colormap = (
+            ],
             self.colormap_name.text(),
-            own_colormap,
         )
+        self.apply(own_colormap)
 
     def _on_click_import_LUT(self):
         self.LUT_file_path = Path(
             QFileDialog.getOpenFileName(self, "Select ImageJ LUT file")[0]
         )
-        # try reading .lut as ascii
         try:
-            lut = np.loadtxt(self.LUT_file_path, delimiter="\t", skiprows=1)
-            self.viewer.layers.selection.active.colormap = (
-                self.LUT_file_path.stem,
-                NpColormap(
-                    lut[:, 1:4] / 255,
-                    name=self.LUT_file_path.stem,
-                    display_name=self.LUT_file_path.stem,
-                ),
-            )
-            return
-        except Exception as e:
-            pass
-        # try reading .lut as binary
-        try:
-            dtype = np.dtype("B")
-            with open(self.LUT_file_path, "rb") as f:
-                numpy_data = np.fromfile(f, dtype)
-            self.viewer.layers.selection.active.colormap = (
-                self.LUT_file_path.stem,
-                NpColormap(
-                    numpy_data.reshape(3, 256).T / 255,
-                    name=self.LUT_file_path.stem,
-                    display_name=self.LUT_file_path.stem,
-                ),
-            )
-        except IOError:
+            lut = read_lut(self.LUT_file_path)
+        except (IOError, ValueError):
             print("Error While Opening the file!")
+            return
+        self.apply(cached_colormap(lut, self.LUT_file_path.stem))
 
-
-# %%
-colormap_widget = CustomWidget()
-viewer.window.add_dock_widget(colormap_widget, area="right", name="Colormap Manager")
+    def _on_click_import_LUT_folder(self):
+        folder = QFileDialog.getExistingDirectory(self, "Select folder of ImageJ LUTs")
+        if not folder:
+            return
+        luts = lut_library(folder)
+        for name, lut in luts.items():
+            # registered with napari, like NapariColormaps, so that the name
+            # is known wherever napari looks colormaps up
+            colormap = ensure_colormap(cached_colormap(lut, name))
+            self._add_colormap_choice(name, colormap)
+        print(f"Added {len(luts)} LUTs from {folder}")
 
 
 # %%
-napari.run()
+if __name__ == "__main__":
+    from skimage import data
+
+    viewer = napari.Viewer()
+    viewer.add_image(data.cells3d()[:, 1, :])
+    colormap_widget = CustomWidget()
+    viewer.window.add_dock_widget(
+        colormap_widget, area="right", name="Colormap Manager"
+    )
+    napari.run()
@@ -0,0 +1,59 @@
+from __future__ import annotations
+
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from napari_scripts_core import LatencyRecorder, latency
+
+if TYPE_CHECKING:
+    import napari
+
+PERCENTILES = (50, 90, 99)
+
+
+def latency_widget(
+    viewer: napari.Viewer, interval: int = 1000, maxlen: int = 1000
+) -> None:
+    """Record the latency of the interactive callbacks and show percentiles.
+
+    Recording is enabled for the line profile, measurement and LIF browser
+    widgets, keeping the last `maxlen` calls of each callback; the table is
+    refreshed every `interval` ms and can be saved as JSON.
+    """
+    # GUI dependencies are only imported once a widget is created
+    from magicgui import magicgui
+    from magicgui.widgets import Table
+    from qtpy.QtCore import QTimer
+
+    latency.enable(maxlen)
+    columns = ["Callback", "n"] + [
+        f"{field} p{q}" for field in LatencyRecorder.FIELDS for q in PERCENTILES
+    ]
+    table = Table(value={column: [] for column in columns})
+
+    def refresh():
+        summary = latency.summary(PERCENTILES)
+        rows = [
+            [name, stats["n"]]
+            + [
+                round(stats[column], 2) if column in stats else ""
+                for column in columns[2:]
+            ]
+            for name, stats in sorted(summary.items())
+        ]
+        table.value = {
+            column: [row[i] for row in rows] for i, column in enumerate(columns)
+        }
+
+    @magicgui(call_button="Save as JSON", path={"mode": "w"})
+    def save_latency(path: Path = Path("latency.json")) -> None:
+        latency.dump(path)
+
+    save_latency.append(table)
+    table.tooltip = "Times in ms; queue: requests waiting or running"
+    timer = QTimer(save_latency.native)
+    timer.timeout.connect(refresh)
+    timer.start(interval)
+
+    widget = save_latency.show()
+    viewer.window.add_dock_widget(widget, name="Callback latency", area="right")
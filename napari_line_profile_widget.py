@@ -1,11 +1,180 @@
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_qt5agg import FigureCanvas
-from skimage import measure
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
 import numpy as np
-import napari
+
+# the sampling itself lives in the headless core module
+from napari_scripts_core import latency, profile_stack
+
+
+class ProfileScheduler:
+    """Coalesce profile update requests and compute them off the GUI thread.
+
+    Only the latest request is kept. At most one computation runs at a time,
+    started at most `max_rate` times per second. Every finished result is
+    drawn, even if a newer request is already pending (that one follows), so
+    the plot keeps up during a continuous drag; only a result older than the
+    one on screen is dropped.
+    """
+
+    def __init__(self, compute, draw, max_rate=60):
+        self.compute = compute
+        self.draw = draw
+        self.interval = 1 / max_rate
+        self._pending = None
+        self._requested = None
+        self._coalesced = 0
+        self._generation = 0
+        self._drawn = 0
+        self._running = False
+        self._timer_armed = False
+        self._last_start = -np.inf
+
+    def request(self, *args):
+        self._generation += 1
+        if self._pending is None:
+            self._requested = time.perf_counter()
+        self._pending = args
+        self._coalesced += 1
+        self._maybe_start()
+
+    def _maybe_start(self):
+        if self._running or self._timer_armed or self._pending is None:
+            return
+        wait = self._last_start + self.interval - time.perf_counter()
+        if wait > 0:
+            from qtpy.QtCore import QTimer
+
+            self._timer_armed = True
+            QTimer.singleShot(int(wait * 1000) + 1, self._on_timer)
+            return
+        args, self._pending = self._pending, None
+        generation = self._generation
+        # for the latency record: when the oldest coalesced request was made,
+        # and how many requests this computation serves
+        requested, queue = self._requested, self._coalesced
+        self._coalesced = 0
+        self._running = True
+        self._last_start = time.perf_counter()
+        from napari.qt.threading import thread_worker
+
+        worker = thread_worker(self._timed_compute, start_thread=False)(*args)
+        worker.returned.connect(
+            lambda result: self._on_returned(generation, requested, queue, *result)
+        )
+        worker.errored.connect(self._on_errored)
+        worker.finished.connect(self._on_finished)
+        worker.start()
+
+    def _on_timer(self):
+        self._timer_armed = False
+        self._maybe_start()
+
+    def _timed_compute(self, *args):
+        start = time.perf_counter()
+        result = self.compute(*args)
+        return result, time.perf_counter() - start
+
+    def _on_returned(self, generation, requested, queue, result, compute):
+        if generation <= self._drawn:
+            latency.record("update_profile (dropped)", compute, compute=compute)
+            return
+        self._drawn = generation
+        start = time.perf_counter()
+        self.draw(result)
+        end = time.perf_counter()
+        latency.record(
+            "update_profile",
+            end - requested,
+            compute=compute,
+            draw=end - start,
+            queue=queue,
+        )
+
+    def _on_errored(self, exc):
+        # e.g. the line or layer changed mid-computation; the next request
+        # recomputes from fresh inputs
+        if not isinstance(exc, (IndexError, KeyError, ValueError)):
+            print(f"Line profile failed: {exc!r}")
+
+    def _on_finished(self):
+        self._running = False
+        self._maybe_start()
 
 
-def profile_line(viewer):
+class ProfilePlot:
+    """Line profile traces on a matplotlib axes, redrawn by blitting.
+
+    Each profile is an animated Line2D keyed by its label. The full figure is
+    only redrawn when traces are added or removed or the axes limits change;
+    otherwise the traces are re-rendered over a cached background.
+    """
+
+    def __init__(self, ax):
+        self.ax = ax
+        self.canvas = ax.figure.canvas
+        self.traces = {}
+        self._background = None
+        self.canvas.mpl_connect("draw_event", self._on_draw)
+
+    def _on_draw(self, event):
+        self._background = self.canvas.copy_from_bbox(self.ax.bbox)
+        self._draw_traces()
+
+    def _draw_traces(self):
+        for trace in self.traces.values():
+            self.ax.draw_artist(trace)
+
+    def _rescale(self, profiles):
+        # x fits the longest line; y only changes when the data leave the
+        # upper 15-50% band, so small intensity changes can be blitted
+        xmax = max(x[-1] if len(x) else 0 for x, _ in profiles.values())
+        ymax = max(np.nanmax(y) if len(y) else 0 for _, y in profiles.values())
+        x0, x1 = self.ax.get_xlim()
+        y0, y1 = self.ax.get_ylim()
+        rescale = False
+        if xmax > 0 and not np.isclose(xmax, x1):
+            self.ax.set_xlim(0, xmax)
+            rescale = True
+        if ymax > 0 and not (0.5 * y1 <= ymax <= y1):
+            self.ax.set_ylim(0, ymax * 1.15)
+            rescale = True
+        return rescale
+
+    def update(self, profiles):
+        """Show `profiles`, a dict of label -> (line length, intensities)."""
+        redraw = set(profiles) != set(self.traces)
+        for label in set(self.traces) - set(profiles):
+            self.traces.pop(label).remove()
+        for label, (line_len, linescan) in profiles.items():
+            if label in self.traces:
+                self.traces[label].set_data(line_len, linescan)
+            else:
+                (self.traces[label],) = self.ax.plot(
+                    line_len, linescan, label=label, animated=True
+                )
+        if profiles:
+            redraw |= self._rescale(profiles)
+        if redraw or self._background is None:
+            if len(self.traces) > 1:
+                self.ax.legend(fontsize="small", frameon=False)
+            elif self.ax.get_legend() is not None:
+                self.ax.get_legend().remove()
+            self.canvas.draw_idle()
+        else:
+            self.canvas.restore_region(self._background)
+            self._draw_traces()
+            self.canvas.blit(self.ax.bbox)
+
+
+def profile_line(viewer, max_rate=60, linewidth=1, reduce="mean"):
+    # GUI dependencies are only imported once a widget is created
+    import matplotlib.pyplot as plt
+    from matplotlib.backends.backend_qt5agg import FigureCanvas
+    import napari
+
     # get top-most, visible image layer
     def get_image_layer():
         for layer in viewer.layers:
@@ -40,30 +209,49 @@ def profile_line(viewer):
     )
     line_prof_layer.mode = "select"
 
-    # get line profile using skimage.measure.profile_line
-    def line_profile(line_prof_layer):
-        # get the top most image layer
-        top_image = get_image_layer()
-        # get scale info
-        px_size = top_image.scale[-2:]
-        if top_image.data.ndim > 2:
-            slice_nr = viewer.dims.current_step[0]
-            slice = top_image.data[slice_nr]
-        else:
-            slice = top_image.data
-        if line_prof_layer.data:
-            if line_prof_layer.shape_type[-1] == "line":
-                linescan = measure.profile_line(
-                    slice,
-                    line_prof_layer.data[-1][0],
-                    line_prof_layer.data[-1][1],
-                    mode="reflect",
-                )
-                return linescan, px_size
+    def get_image_layers():
+        return [
+            layer
+            for layer in viewer.layers
+            if isinstance(layer, napari.layers.Image) and layer.visible != 0
+        ]
+
+    # collect the inputs of the profiles on the GUI thread:
+    # one per line in the shapes layer and visible image layer
+    def profile_inputs(line_prof_layer):
+        lines = [
+            np.array(data)
+            for data, shape_type in zip(
+                line_prof_layer.data, line_prof_layer.shape_type
+            )
+            if shape_type == "line"
+        ]
+        if not lines:
+            print("no line")
+            return None
+        channels = []
+        for layer in get_image_layers():
+            # get scale info
+            px_size = layer.scale[-2:]
+            if layer.data.ndim > 2:
+                step = viewer.dims.current_step[-layer.data.ndim : -2]
+                slice = layer.data[tuple(step)]
             else:
-                print("no line")
-        else:
-            print("No data")
+                slice = layer.data
+            channels.append((layer.name, slice, px_size))
+        return (lines, channels)
+
+    # get line profiles, sampled like skimage.measure.profile_line
+    def compute_profile(lines, channels):
+        profiles = {}
+        for i, (src, dst) in enumerate(lines):
+            for name, slice, px_size in channels:
+                linescan = profile_stack(
+                    slice, src, dst, linewidth=linewidth, reduce=reduce
+                )
+                line_len = np.arange(len(linescan)) * px_size[-1]
+                profiles[f"{name} (line {i + 1})"] = (line_len, linescan)
+        return profiles
 
     # set params and create mpl figure with subplots
     plt.rcParams.update(
@@ -81,30 +269,20 @@ def profile_line(viewer):
     viewer.window.add_dock_widget(
         FigureCanvas(mpl_fig), area="bottom", name="Line profile"
     )
-
-    linescan, px_size = line_profile(line_prof_layer)
-    # define the length of the line using px scale (round to try to avoid length mismatch)
-    line_len = np.arange(
-        0, round(len(linescan) * round(px_size[-1], 3), 3), round(px_size[-1], 3)
-    )
-    (line,) = ax.plot(line_len, linescan)
-    axes = plt.gca()
-    axes.set_xlim(np.min(line_len), np.max(line_len))
-    axes.set_ylim(0, np.max(linescan) * (1.15))
     ax.set_xlabel(f"Line length ({units})", color="grey")
     ax.set_ylabel("Intensity (AU)", color="grey")
+    plot = ProfilePlot(ax)
+    plot.update(compute_profile(*profile_inputs(line_prof_layer)))
     plt.tight_layout()
-    line.figure.canvas.draw()
+    mpl_fig.canvas.draw()
+
+    # updates are coalesced, rate limited and computed in a worker thread
+    scheduler = ProfileScheduler(compute_profile, plot.update, max_rate=max_rate)
 
     def update_profile(line_prof_layer):
-        linescan, px_size = line_profile(line_prof_layer)
-        line_len = np.arange(
-            0, round(len(linescan) * round(px_size[-1], 3), 3), round(px_size[-1], 3)
-        )
-        line.set_data(line_len, linescan)
-        axes.set_xlim(np.min(line_len), np.max(line_len))
-        axes.set_ylim(0, np.max(linescan) * (1.15))
-        line.figure.canvas.draw_idle()
+        inputs = profile_inputs(line_prof_layer)
+        if inputs is not None:
+            scheduler.request(*inputs)
 
     # connect a callback that updates the line plot via mouse drag
     @line_prof_layer.mouse_drag_callbacks.append
@@ -112,34 +290,58 @@ def profile_line(viewer):
         yield
         while event.type == "mouse_move":
             try:
-                update_profile(line_prof_layer)
+                with latency.timed("profile_lines_drag"):
+                    update_profile(line_prof_layer)
                 yield
             except IndexError:
                 pass
             except KeyError:
                 pass
 
+    # refresh when lines are added, removed or edited
+    @line_prof_layer.events.data.connect
+    def profile_lines_data(event):
+        update_profile(line_prof_layer)
+
     # connect to dimension slider to update on scroll
     @viewer.dims.events.current_step.connect
     def profile_lines_slice(event):
-        update_profile(line_prof_layer)
-
-    # refresh on layer move
-    @viewer.layers.events.reordered.connect
-    def update_layers(event):
-        img_layer = get_image_layer()
-        img_layer.events.visible.connect(check_vis)
-        update_profile(line_prof_layer)
+        with latency.timed("profile_lines_slice"):
+            update_profile(line_prof_layer)
 
     # refresh on image layer visibility change
-    @img_layer.events.visible.connect
     def check_vis(event):
-        update_profile(line_prof_layer)
+        with latency.timed("check_vis"):
+            update_profile(line_prof_layer)
+
+    # refresh on layer move, addition or removal
+    def update_layers(event):
+        with latency.timed("update_layers"):
+            for layer in viewer.layers:
+                if isinstance(layer, napari.layers.Image):
+                    layer.events.visible.connect(check_vis)
+            update_profile(line_prof_layer)
+
+    viewer.layers.events.reordered.connect(update_layers)
+    viewer.layers.events.inserted.connect(update_layers)
+    viewer.layers.events.removed.connect(update_layers)
+    update_layers(None)
 
-    return line
+    return plot
+
+
+def plot_traces(ax, line):
+    # copy the traces of a ProfilePlot (or a single Line2D) onto `ax`
+    traces = list(line.traces.values()) if isinstance(line, ProfilePlot) else [line]
+    for trace in traces:
+        ax.plot(trace.get_xdata(), trace.get_ydata(), label=trace.get_label())
+    if len(traces) > 1:
+        ax.legend(fontsize="small", frameon=False)
 
 
 def get_figure(line, viewer, name=None, screenshot=True):
+    import matplotlib.pyplot as plt
+
     if screenshot is True:
         screeny = viewer.screenshot()
         dpi = 300
@@ -173,9 +375,7 @@ def get_figure(line, viewer, name=None, screenshot=True):
                 fontweight="bold",
                 va="top",
             )
-            x_data = line.get_xdata()
-            y_data = line.get_ydata()
-            ax[1].plot(x_data, y_data)
+            plot_traces(ax[1], line)
             ax[1].set_xlabel(f"Line length ({units})", loc="right")
             ax[1].set_ylabel("Intensity (AU)")
             ax[1].text(
@@ -202,11 +402,109 @@ def get_figure(line, viewer, name=None, screenshot=True):
             )
             fig = plt.figure(figsize=(6, 3), dpi=300)
             ax = fig.add_subplot(1, 1, 1)
-            x_data = line.get_xdata()
-            y_data = line.get_ydata()
-            ax.plot(x_data, y_data)
+            plot_traces(ax, line)
             ax.set_xlabel(f"Line length ({units})", loc="right")
             ax.set_ylabel("Intensity (AU)", loc="top")
             if name is not None:
                 fig.savefig(name, dpi=fig.dpi)
             plt.show()
+
+
+def profile_panels(images, lines, px_size=1.0, linewidth=1, reduce="mean"):
+    """Line profile panels for `export_profile_figures`, without a viewer.
+
+    `images` maps channel names to 2D images or stacks with the same leading
+    (e.g. T, Z) dims; every line and plane gives a panel with one trace per
+    channel, named "line{i}" or "line{i}_{t}_{z}..." after its plane.
+    """
+    panels = {}
+    for i, (src, dst) in enumerate(lines):
+        for channel, image in images.items():
+            profiles = np.asarray(
+                profile_stack(image, src, dst, linewidth=linewidth, reduce=reduce)
+            )
+            line_len = np.arange(profiles.shape[-1]) * px_size
+            for plane in np.ndindex(*profiles.shape[:-1]):
+                name = "_".join([f"line{i + 1}", *map(str, plane)])
+                traces = panels.setdefault(name, {"name": name, "traces": {}})
+                traces["traces"][channel] = (line_len, profiles[plane])
+    return list(panels.values())
+
+
+def _render_panels(panels, out_dir, formats, units, dpi):
+    # one offscreen figure per worker, its artists updated for every panel
+    from matplotlib import rc_context
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    # the fonts are only set while rendering: with one worker this runs in
+    # the caller's process, next to the live profile plot
+    with rc_context(
+        {
+            "font.family": "sans-serif",
+            "font.sans-serif": ["Fira Sans", "DejaVu Sans"],
+            "font.size": 10,
+        }
+    ):
+        fig = Figure(figsize=(6, 3), dpi=dpi)
+        FigureCanvasAgg(fig)
+        # fixed margins instead of a layout engine, which would draw twice per file
+        fig.subplots_adjust(left=0.14, right=0.97, bottom=0.17, top=0.95)
+        ax = fig.add_subplot(1, 1, 1)
+        ax.set_xlabel(f"Line length ({units})", loc="right")
+        ax.set_ylabel("Intensity (AU)", loc="top")
+        traces = []
+        labels = None
+        written = []
+        for panel in panels:
+            profiles = panel["traces"]
+            while len(traces) < len(profiles):
+                (trace,) = ax.plot([], [])
+                traces.append(trace)
+            for trace, (label, (line_len, linescan)) in zip(traces, profiles.items()):
+                trace.set_data(line_len, linescan)
+                trace.set_label(label)
+                trace.set_visible(True)
+            for trace in traces[len(profiles) :]:
+                trace.set_visible(False)
+            if list(profiles) != labels:
+                labels = list(profiles)
+                if ax.get_legend() is not None:
+                    ax.get_legend().remove()
+                if len(profiles) > 1:
+                    ax.legend(
+                        handles=traces[: len(profiles)], fontsize="small", frameon=False
+                    )
+            ax.relim(visible_only=True)
+            ax.autoscale_view()
+            for fmt in formats:
+                path = Path(out_dir) / f"{panel['name']}.{fmt}"
+                fig.savefig(path, format=fmt)
+                written.append(path)
+    return written
+
+
+def export_profile_figures(
+    panels, out_dir, formats=("png",), units="px", dpi=300, workers=None
+):
+    """Save a line profile figure (PNG, PDF, SVG, ...) for each panel.
+
+    A panel is a dict with a file "name" and "traces", a dict of label ->
+    (line length, intensities), e.g. from `profile_panels`. The panels are
+    split over `workers` processes that each reuse one offscreen (Agg) figure.
+    Returns the paths of the written files.
+    """
+    panels = list(panels)
+    Path(out_dir).mkdir(parents=True, exist_ok=True)
+    workers = min(workers or os.cpu_count() or 1, max(len(panels), 1))
+    formats = (formats,) if isinstance(formats, str) else tuple(formats)
+    if workers == 1:
+        return _render_panels(panels, out_dir, formats, units, dpi)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(
+                _render_panels, panels[i::workers], out_dir, formats, units, dpi
+            )
+            for i in range(workers)
+        ]
+        return [path for future in futures for path in future.result()]
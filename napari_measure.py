@@ -1,16 +1,30 @@
 from __future__ import annotations
 
-import math
 from typing import TYPE_CHECKING
 
-import napari
 import numpy as np
 
+from napari_scripts_core import SHAPE_NAMES, measure_shapes
+
 if TYPE_CHECKING:
     import napari.layers, napari.viewer
 
 
-def measure_shape(keybind:str="m")->None:
+def print_measurements(table: dict, i: int, units: str) -> None:
+    length = table[f"Length ({units})"][i]
+    area = table[f"Area ({units}\u00b2)"][i]
+    angle = table["Angle (°)"][i]
+    if not np.isnan(length):
+        print(f"Length: {round(length, 1)} {units}")
+    if not np.isnan(area):
+        print(f"Area: {round(area)} {units}\u00b2")
+    if not np.isnan(angle):
+        print(f"Angle: {round(angle, 1)}°")
+
+
+def measure_shape(keybind:str="m", all_keybind:str="Shift-M")->None:
+    import napari
+
     viewer = napari.current_viewer()
     # get top-most, visible image layer
     img_layer = None
@@ -51,47 +65,18 @@ def measure_shape(keybind:str="m")->None:
                 m_shape_vertices = layer.data[-1]
                 m_shape_type = layer.shape_type[-1]
                 
-            if m_shape_type == "line":
-                length = math.dist(*m_shape_vertices) * px_size[-1]
-                print(f"Length: {round(length, 1)} {units}")
-            elif m_shape_type == "rectangle":
-                area = (
-                    math.dist(m_shape_vertices[0], m_shape_vertices[1])
-                    * math.dist(m_shape_vertices[0], m_shape_vertices[3])
-                    * px_size[-1] ** 2
-                )
-                print(f"Area: {round(area)} {units}\u00b2")
-            elif m_shape_type == "ellipse":
-                area = (
-                    math.pi
-                    * 0.5
-                    * math.dist(m_shape_vertices[0], m_shape_vertices[1])
-                    * 0.5
-                    * math.dist(m_shape_vertices[0], m_shape_vertices[3])
-                ) * px_size[-1] ** 2
-                print(f"Area: {round(area)} {units}\u00b2")
-            elif m_shape_type == "polygon":
-                i = np.arange(len(m_shape_vertices))
-                area = (
-                    0.5
-                    * np.abs(np.sum(np.cross(m_shape_vertices[i - 1], m_shape_vertices[i])))
-                    * px_size[-1] ** 2
-                )
-                print(f"Area: {round(area)} {units}\u00b2")
-            elif m_shape_type == "path":
-                length = 0
-                for i in range(len(m_shape_vertices) - 1):
-                    length += (
-                        math.dist(m_shape_vertices[i], m_shape_vertices[i + 1])
-                        * px_size[-1]
-                    )
-                print(f"Length: {round(length, 1)} {units}")
-                if m_shape_vertices.shape[0] == 3:
-                    angle_rad = np.arccos(np.inner(m_shape_vertices[0]-m_shape_vertices[1], m_shape_vertices[2]-m_shape_vertices[1])/(np.linalg.norm(m_shape_vertices[1]-m_shape_vertices[0])*np.linalg.norm(m_shape_vertices[2]-m_shape_vertices[1])))
-                    angle_deg = np.rad2deg(angle_rad)
-                    print(f"Angle: {round(angle_deg, 1)}°")
-                    
-            else:
+            if m_shape_type not in SHAPE_NAMES:
                 print("Not a line, path, rectangle, polygon, or ellipse")
+                return
+            table = measure_shapes([m_shape_vertices], [m_shape_type], px_size, units)
+            print_measurements(table, 0, units)
         else:
             print("No shape drawn yet")
+
+    @viewer.bind_key(all_keybind)
+    def measure_all(viewer: napari.Viewer) -> None:
+        layer = viewer.layers["Measure"]
+        table = measure_shapes(layer.data, layer.shape_type, px_size, units)
+        for i, shape in enumerate(table["Shape"]):
+            print(f"{i}: {shape}")
+            print_measurements(table, i, units)
@@ -1,20 +1,52 @@
 from __future__ import annotations
 
-import math
+import time
+from pathlib import Path
 from typing import TYPE_CHECKING
 
-import napari
 import numpy as np
-from magicgui import magicgui
+
+# the measurements themselves live in the headless core module
+from napari_scripts_core import (
+    MeasurementCache,
+    ResultStore,
+    ShapeIndex,
+    latency,
+    measure_shapes,
+)
 
 if TYPE_CHECKING:
+    import napari
     import napari.layers
     import napari.types
+    from magicgui.widgets import Table
+
+
+def _patch_table(table: Table, start: int, n_removed: int, new_rows: list[list]):
+    """Apply a `MeasurementCache.update` patch to a magicgui Table in place."""
+    n_replaced = min(n_removed, len(new_rows))
+    for i in range(n_replaced):
+        table.data[start + i] = new_rows[i]
+    for _ in range(n_removed - n_replaced):
+        del table.data[start + n_replaced]
+    for i in range(n_replaced, len(new_rows)):
+        table.native.insertRow(start + i)
+        table.data[start + i] = new_rows[i]
 
 
 def measure_shape(
-    viewer: napari.Viewer, keybind: str = "m", overwrite: bool = False
+    viewer: napari.Viewer,
+    keybind: str = "m",
+    overwrite: bool = False,
+    all_keybind: str = "Shift-M",
+    autosave: str | Path | None = None,
+    neighbour_radius: float | None = None,
 ) -> None:
+    # GUI dependencies are only imported once a widget is created
+    import napari
+    from magicgui import magicgui
+    from magicgui.widgets import Table
+
     # get top-most, visible image layer
     img_layer = None
     for layer in viewer.layers:
@@ -25,6 +57,8 @@ def measure_shape(
 
     # get img dimensions
     px_size = img_layer.scale[-2:]
+    # intensities are measured on the full resolution data
+    image = img_layer.data[0] if img_layer.multiscale else img_layer.data
 
     if viewer.scale_bar.unit is None:
         units = "px"
@@ -43,96 +77,128 @@ def measure_shape(
     )
     measure_layer.mode = "add_line"
 
+    # optionally index the shapes for the nearest neighbour distance, the
+    # number of neighbours within `neighbour_radius` and the box overlaps
+    index = None
+    neighbour_columns = []
+    if neighbour_radius is not None:
+        index = ShapeIndex(px_size, neighbour_radius, units)
+        neighbour_columns = index.columns
+    # neighbour values of each shape, as shown in the live table
+    neighbours = np.empty((0, len(neighbour_columns)))
+
     # prep results table for the table widget
-    result_table = {
-        "Shape": [],
-        f"Length ({units})": [],
-        "Angle (°)": [],
-        f"Area ({units}\u00b2)": [],
-    }
+    result_table = ResultStore(
+        list(measure_shapes([], [], px_size, units, image)) + neighbour_columns
+    )
 
     @viewer.bind_key(keybind, overwrite=overwrite)
     @magicgui(call_button=f"Measure ({keybind})", result_widget=True)
     def measure_prop(viewer: napari.Viewer) -> magicgui.widgets.Table:
+        start = time.perf_counter()
         layer = measure_layer
         if layer.data:
             # Check if a shape is selected, if so use that shape
             if layer.selected_data:
-                m_shape_vertices = layer.data[[*layer.selected_data][0]]
-                m_shape_type = layer.shape_type[[*layer.selected_data][0]]
+                i = [*layer.selected_data][0]
             else:  # otherwise use the last shape
-                m_shape_vertices = layer.data[-1]
-                m_shape_type = layer.shape_type[-1]
-
-            if m_shape_type == "line":
-                length = math.dist(*m_shape_vertices) * px_size[-1]
-                result_table["Shape"].append("Line")
-                result_table[f"Length ({units})"].append(round(length))
-                result_table["Angle (°)"].append("N/A")
-                result_table[f"Area ({units}\u00b2)"].append("N/A")
-            elif m_shape_type == "rectangle":
-                area = (
-                    math.dist(m_shape_vertices[0], m_shape_vertices[1])
-                    * math.dist(m_shape_vertices[0], m_shape_vertices[3])
-                    * px_size[-1] ** 2
-                )
-                result_table["Shape"].append("Rectangle")
-                result_table[f"Length ({units})"].append("N/A")
-                result_table["Angle (°)"].append("N/A")
-                result_table[f"Area ({units}\u00b2)"].append(round(area))
-            elif m_shape_type == "ellipse":
-                area = (
-                    math.pi
-                    * 0.5
-                    * math.dist(m_shape_vertices[0], m_shape_vertices[1])
-                    * 0.5
-                    * math.dist(m_shape_vertices[0], m_shape_vertices[3])
-                ) * px_size[-1] ** 2
-                result_table["Shape"].append("Ellipse")
-                result_table[f"Area ({units}\u00b2)"].append(round(area))
-                result_table[f"Length ({units})"].append("N/A")
-                result_table["Angle (°)"].append("N/A")
-            elif m_shape_type == "polygon":
-                i = np.arange(len(m_shape_vertices))
-                area = (
-                    0.5
-                    * np.abs(
-                        np.sum(np.cross(m_shape_vertices[i - 1], m_shape_vertices[i]))
-                    )
-                    * px_size[-1] ** 2
-                )
-                result_table["Shape"].append("Polygon")
-                result_table[f"Area ({units}\u00b2)"].append(round(area))
-                result_table[f"Length ({units})"].append("N/A")
-                result_table["Angle (°)"].append("N/A")
-            elif m_shape_type == "path":
-                length = 0
-                for i in range(len(m_shape_vertices) - 1):
-                    length += (
-                        math.dist(m_shape_vertices[i], m_shape_vertices[i + 1])
-                        * px_size[-1]
-                    )
-                if m_shape_vertices.shape[0] == 3:
-                    angle_rad = np.arccos(
-                        np.inner(
-                            m_shape_vertices[0] - m_shape_vertices[1],
-                            m_shape_vertices[2] - m_shape_vertices[1],
-                        )
-                        / (
-                            np.linalg.norm(m_shape_vertices[1] - m_shape_vertices[0])
-                            * np.linalg.norm(m_shape_vertices[2] - m_shape_vertices[1])
-                        )
-                    )
-                    angle_deg = np.rad2deg(angle_rad)
-                    result_table["Angle (°)"].append(round(angle_deg))
-                else:
-                    result_table["Angle (°)"].append("N/A")
-
-                result_table["Shape"].append("Path")
-                result_table[f"Length ({units})"].append(round(length))
-                result_table[f"Area ({units}\u00b2)"].append("N/A")
-
-        return result_table
+                i = len(layer.data) - 1
+            m_shape_vertices = layer.data[i]
+            m_shape_type = layer.shape_type[i]
+
+            measurements = measure_shapes(
+                [m_shape_vertices], [m_shape_type], px_size, units, image
+            )
+            for k, column in enumerate(neighbour_columns):
+                measurements[column] = neighbours[i : i + 1, k]
+            result_table.extend(measurements)
+            if autosave is not None:
+                result_table.export_async(autosave)
+
+        measured = time.perf_counter()
+        table = result_table.to_dict()
+        end = time.perf_counter()
+        latency.record(
+            "measure_prop",
+            end - start,
+            compute=measured - start,
+            draw=end - measured,
+        )
+        return table
+
+    @magicgui(call_button="Export results", path={"mode": "w"})
+    def export_results(path: Path = Path("measurements.csv")) -> None:
+        result_table.export_async(path)
+
+    measure_prop.append(export_results)
+
+    # live table of all shapes, patched as the Measure layer changes
+    cache = MeasurementCache(px_size, units, image)
+    columns = cache.columns + neighbour_columns
+    live_table = Table(value={column: [] for column in columns})
+
+    def sync_table() -> None:
+        nonlocal neighbours
+        start = time.perf_counter()
+        first, n_removed, new_rows = cache.update(
+            measure_layer.data, measure_layer.shape_type
+        )
+        changed = []
+        if index is not None:
+            # an edit also changes the neighbours of the other shapes, so the
+            # rows outside the patch whose neighbour values changed are updated
+            last = first + len(new_rows)
+            index.update(first, n_removed, measure_layer.data[first:last])
+            values = np.column_stack(list(index.neighbours().values()))
+            new_rows = [
+                row + values[i].tolist() for i, row in enumerate(new_rows, first)
+            ]
+            shown = np.concatenate(
+                [
+                    neighbours[:first],
+                    values[first:last],
+                    neighbours[first + n_removed :],
+                ]
+            )
+            changed = np.flatnonzero(
+                ~np.isclose(shown, values, equal_nan=True).all(axis=1)
+            ).tolist()
+        measured = time.perf_counter()
+        _patch_table(live_table, first, n_removed, new_rows)
+        for i in changed:
+            live_table.data[i] = cache.rows[i] + values[i].tolist()
+        if index is not None:
+            # only once the table shows them
+            neighbours = values
+        end = time.perf_counter()
+        latency.record(
+            "sync_table",
+            end - start,
+            compute=measured - start,
+            draw=end - measured,
+        )
+
+    @measure_layer.events.data.connect
+    def remeasure(event):
+        # newer napari also emits "adding", "removing", ... before the change
+        if getattr(event, "action", "changed") in ("added", "removed", "changed"):
+            sync_table()
+
+    @viewer.bind_key(all_keybind, overwrite=overwrite)
+    @magicgui(call_button=f"Measure all ({all_keybind})")
+    def measure_all(viewer: napari.Viewer) -> None:
+        nonlocal neighbours
+        cache.clear()
+        if index is not None:
+            index.clear()
+        neighbours = np.empty((0, len(neighbour_columns)))
+        live_table.value = {column: [] for column in columns}
+        sync_table()
+
+    measure_all.append(live_table)
+    sync_table()
 
     widget = measure_prop.show()
     viewer.window.add_dock_widget(widget, name="Measure Shapes", area="bottom")
+    all_widget = measure_all.show()
+    viewer.window.add_dock_widget(all_widget, name="Measure All Shapes", area="bottom")
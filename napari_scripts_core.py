@@ -0,0 +1,1154 @@
+"""Headless numerical core of the napari scripts.
+
+Line profile sampling, shape measurements and ImageJ LUT parsing, using only
+NumPy at import time (SciPy and scikit-image are imported on first use), so
+it can be used in batch jobs without a display, Qt or a napari viewer.
+"""
+
+from __future__ import annotations
+
+import csv
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import lru_cache
+from pathlib import Path
+from typing import Iterator
+
+import numpy as np
+
+REDUCE_FUNCS = {"mean": np.mean, "median": np.median, "max": np.max}
+
+
+def line_coordinates(src, dst, linewidth=1):
+    """Sample grid (2, N, linewidth) of a line, as in skimage.measure.profile_line.
+
+    Both end points are included and samples are ~1 px apart along the line;
+    for thick lines, `linewidth` parallel lines are sampled 1 px apart.
+    """
+    src = np.asarray(src, dtype=float)[-2:]
+    dst = np.asarray(dst, dtype=float)[-2:]
+    d_row, d_col = dst - src
+    length = int(np.ceil(np.hypot(d_row, d_col) + 1))
+    coords = np.linspace(src, dst, length).T
+    # unit vector perpendicular to the line
+    normal = np.array([d_col, -d_row]) / max(np.hypot(d_row, d_col), 1e-12)
+    offsets = np.linspace(-(linewidth - 1) / 2, (linewidth - 1) / 2, linewidth)
+    return coords[:, :, None] + normal[:, None, None] * offsets
+
+
+@lru_cache(maxsize=128)
+def _line_geometry(src, dst, order, linewidth):
+    # sample grid relative to the line's bounding box, padded so that
+    # interpolation of the given order never reads outside of it
+    coords = line_coordinates(src, dst, linewidth)
+    pad = max(order, 1)
+    flat = coords.reshape(2, -1)
+    lo = np.floor(flat.min(axis=1)).astype(int) - pad
+    hi = np.ceil(flat.max(axis=1)).astype(int) + pad + 1
+    coords = coords - lo[:, None, None]
+    coords.flags.writeable = False
+    return coords, lo, hi
+
+
+def crop_to_line(stack, src, dst, order=1, linewidth=1):
+    """Crop the YX axes of `stack` to the padded bounding box of a line.
+
+    Returns the cropped (still lazy, for dask) stack and the sample grid of
+    the line inside the crop. Grids are cached per line geometry, so repeated
+    calls while dragging a line, or for other slices and channels, are cheap.
+    """
+    src = tuple(float(v) for v in np.asarray(src)[-2:])
+    dst = tuple(float(v) for v in np.asarray(dst)[-2:])
+    coords, lo, hi = _line_geometry(src, dst, order, linewidth)
+    shape = np.array(stack.shape[-2:])
+    start = np.clip(lo, 0, shape - 1)
+    stop = np.maximum(np.minimum(hi, shape), start + 1)
+    window = stack[..., start[0] : stop[0], start[1] : stop[1]]
+    return window, coords + (lo - start)[:, None, None]
+
+
+def _profile_block(block, coords, order, mode, reduce):
+    # sample every plane of a (..., Y, X) block in one map_coordinates call,
+    # then reduce across the line width in one call
+    from scipy import ndimage as ndi
+
+    planes = block.reshape(-1, *block.shape[-2:])
+    n_planes, n_samples = planes.shape[0], coords.shape[1]
+    grid = np.empty((3, n_planes, *coords.shape[1:]))
+    grid[0] = np.arange(n_planes)[:, None, None]
+    grid[1:] = coords[:, None]
+    profiles = ndi.map_coordinates(
+        planes, grid, order=order, mode=mode, prefilter=order > 1
+    )
+    profiles = REDUCE_FUNCS[reduce](profiles, axis=-1)
+    return profiles.reshape(*block.shape[:-2], n_samples)
+
+
+def profile_stack(
+    stack, src, dst, planes=None, order=1, mode="reflect", linewidth=1, reduce="mean"
+):
+    """Profile one line through every YX plane of a stack.
+
+    The sample grid is computed once and applied to all leading-axis slices
+    (or to `planes`, a slice/index array along the first axis) at once.
+    Only the bounding box of the line is read, so cost scales with the line
+    length rather than the image size. Dask arrays are processed chunk-wise,
+    one call per chunk of planes.
+    Thick lines (`linewidth` > 1) are averaged across their width with
+    `reduce`: "mean", "median" or "max".
+    Returns an array of shape (*leading dims, N), e.g. a (T, N) kymograph.
+    """
+    if reduce not in REDUCE_FUNCS:
+        raise ValueError(f"reduce must be one of {list(REDUCE_FUNCS)}, not {reduce!r}")
+    if planes is not None:
+        stack = stack[planes]
+    stack, coords = crop_to_line(stack, src, dst, order, linewidth)
+    if hasattr(stack, "map_blocks"):  # dask array
+        stack = stack.rechunk({stack.ndim - 2: -1, stack.ndim - 1: -1})
+        return stack.map_blocks(
+            _profile_block,
+            coords,
+            order,
+            mode,
+            reduce,
+            dtype=float,
+            drop_axis=(stack.ndim - 2, stack.ndim - 1),
+            new_axis=stack.ndim - 2,
+            chunks=(*stack.chunks[:-2], (coords.shape[1],)),
+        ).compute()
+    return _profile_block(np.asarray(stack), coords, order, mode, reduce)
+
+
+SHAPE_NAMES = {
+    "line": "Line",
+    "rectangle": "Rectangle",
+    "ellipse": "Ellipse",
+    "polygon": "Polygon",
+    "path": "Path",
+}
+
+
+def _pad_vertices(vertices: list[np.ndarray]) -> tuple[np.ndarray, np.ndarray]:
+    """Stack ragged (N_i, D) vertex arrays into an edge-padded (n, max N_i, 2) array.
+
+    Only the last two (y, x) axes are kept. Each shape is padded by repeating
+    its last vertex, which adds zero-length segments to paths and zero terms
+    to the shoelace sum, so padded shapes measure the same as unpadded ones.
+    """
+    counts = np.fromiter((len(v) for v in vertices), dtype=np.intp, count=len(vertices))
+    flat = np.concatenate([np.asarray(v, dtype=float)[:, -2:] for v in vertices])
+    offsets = np.cumsum(counts) - counts
+    cols = np.minimum(np.arange(counts.max()), (counts - 1)[:, None])
+    return flat[offsets[:, None] + cols], counts
+
+
+def measure_shapes(
+    data: list[np.ndarray],
+    shape_types: list[str],
+    px_size: np.ndarray,
+    units: str = "px",
+    image: np.ndarray | None = None,
+) -> dict[str, np.ndarray]:
+    """Measure every shape of a Shapes layer at once.
+
+    Vertices are grouped by `shape_type` and padded into NumPy arrays, so
+    lengths, areas and angles are computed per group rather than per shape.
+    Returns a columnar table (same columns as the widget result table) with
+    NaN where a measurement does not apply to a shape. If `image` is given,
+    the intensity columns of `intensity_stats` are added as well.
+    """
+    n = len(data)
+    shape_types = np.asarray(shape_types, dtype=object)
+    table = {
+        "Shape": np.array(
+            [SHAPE_NAMES.get(t, str(t).capitalize()) for t in shape_types]
+        ),
+        f"Length ({units})": np.full(n, np.nan),
+        "Angle (°)": np.full(n, np.nan),
+        f"Area ({units}\u00b2)": np.full(n, np.nan),
+    }
+    if n == 0:
+        if image is not None:
+            table.update(intensity_stats(image, data, shape_types))
+        return table
+    scale = np.asarray(px_size, dtype=float)[-2:]
+
+    # line and path: sum of segment lengths, angle for 3-point paths
+    idx = np.flatnonzero((shape_types == "line") | (shape_types == "path"))
+    if idx.size:
+        verts, counts = _pad_vertices([data[i] for i in idx])
+        verts = verts * scale
+        segments = np.diff(verts, axis=1)
+        table[f"Length ({units})"][idx] = np.linalg.norm(segments, axis=-1).sum(axis=1)
+        three = (counts == 3) & (shape_types[idx] == "path")
+        if three.any():
+            arms_a = verts[three, 0] - verts[three, 1]
+            arms_b = verts[three, 2] - verts[three, 1]
+            cos = np.einsum("ij,ij->i", arms_a, arms_b) / (
+                np.linalg.norm(arms_a, axis=-1) * np.linalg.norm(arms_b, axis=-1)
+            )
+            table["Angle (°)"][idx[three]] = np.rad2deg(np.arccos(np.clip(cos, -1, 1)))
+
+    # rectangle and ellipse: sides from the 4 bounding-box corners
+    idx = np.flatnonzero((shape_types == "rectangle") | (shape_types == "ellipse"))
+    if idx.size:
+        verts = np.stack([np.asarray(data[i], dtype=float)[:4, -2:] for i in idx])
+        verts = verts * scale
+        side_a = np.linalg.norm(verts[:, 1] - verts[:, 0], axis=-1)
+        side_b = np.linalg.norm(verts[:, 3] - verts[:, 0], axis=-1)
+        area = side_a * side_b
+        area[shape_types[idx] == "ellipse"] *= np.pi / 4
+        table[f"Area ({units}\u00b2)"][idx] = area
+
+    # polygon: shoelace formula on the padded vertices
+    idx = np.flatnonzero(shape_types == "polygon")
+    if idx.size:
+        verts, _ = _pad_vertices([data[i] for i in idx])
+        verts = verts * scale
+        rolled = np.roll(verts, 1, axis=1)
+        cross = rolled[..., 0] * verts[..., 1] - rolled[..., 1] * verts[..., 0]
+        table[f"Area ({units}\u00b2)"][idx] = 0.5 * np.abs(cross.sum(axis=1))
+
+    if image is not None:
+        table.update(intensity_stats(image, data, shape_types))
+    return table
+
+
+def _roi_pixels(
+    vertices: np.ndarray, shape_type: str, plane_shape: tuple[int, int]
+) -> tuple[np.ndarray, np.ndarray]:
+    """Return (rows, cols) of the pixels of a (H, W) plane covered by a shape.
+
+    Areas are rasterized only inside the shape's own bounding box, lines and
+    paths are rasterized segment by segment.
+    """
+    from skimage import draw
+
+    verts = np.asarray(vertices, dtype=float)[:, -2:]
+    height, width = plane_shape
+    if shape_type in ("line", "path"):
+        ints = np.round(verts).astype(int)
+        segments = [draw.line(*a, *b) for a, b in zip(ints[:-1], ints[1:])]
+        rr = np.concatenate([s[0] for s in segments])
+        cc = np.concatenate([s[1] for s in segments])
+        keep = (rr >= 0) & (rr < height) & (cc >= 0) & (cc < width)
+        flat = np.unique(rr[keep] * width + cc[keep])
+        return flat // width, flat % width
+
+    if shape_type == "ellipse":
+        # napari stores ellipses as the 4 corners of their bounding box
+        center = verts.mean(axis=0)
+        half_a = (verts[1] - verts[0]) / 2
+        half_b = (verts[3] - verts[0]) / 2
+        t = np.linspace(0, 2 * np.pi, 64, endpoint=False)[:, None]
+        verts = center + np.cos(t) * half_a + np.sin(t) * half_b
+    y0, x0 = np.maximum(np.floor(verts.min(axis=0)).astype(int), 0)
+    y1, x1 = np.minimum(np.ceil(verts.max(axis=0)).astype(int) + 1, plane_shape)
+    if y0 >= y1 or x0 >= x1:
+        return np.empty(0, dtype=int), np.empty(0, dtype=int)
+    rr, cc = draw.polygon(verts[:, 0] - y0, verts[:, 1] - x0, shape=(y1 - y0, x1 - x0))
+    return rr + y0, cc + x0
+
+
+def intensity_stats(
+    image: np.ndarray, data: list[np.ndarray], shape_types: list[str]
+) -> dict[str, np.ndarray]:
+    """Mean, sum, min, max and std of `image` inside each shape.
+
+    Shapes are grouped by the plane they are drawn on (their leading,
+    non-YX coordinates). For each plane the ROI pixels are rasterized per
+    bounding box and concatenated with a label per ROI, only the window
+    spanning all ROIs is read from `image` (which may be a dask array), and
+    the statistics are reduced for all ROIs at once with `np.bincount` and
+    `np.ufunc.reduceat`. Overlapping ROIs are supported and no frame-sized mask
+    is ever allocated.
+    """
+    n = len(data)
+    stats = {name: np.full(n, np.nan) for name in ("Mean", "Sum", "Min", "Max", "Std")}
+    lead_ndim = image.ndim - 2
+    plane_shape = image.shape[-2:]
+    planes = {}
+    for i, vertices in enumerate(data):
+        coords = np.asarray(vertices)[0, :-2]
+        if coords.size < lead_ndim:
+            # e.g. 2D annotations of a stack: the plane they are on is unknown
+            raise ValueError(
+                f"Shape {i} has {coords.size + 2} coordinates, "
+                f"but the image has {image.ndim} dimensions"
+            )
+        lead = np.round(coords[coords.size - lead_ndim :]).astype(int)
+        lead = np.clip(lead, 0, np.array(image.shape[:lead_ndim]) - 1)
+        planes.setdefault(tuple(lead.tolist()), []).append(i)
+
+    for lead, idx in planes.items():
+        idx = np.asarray(idx)
+        pixels = [_roi_pixels(data[i], shape_types[i], plane_shape) for i in idx]
+        counts = np.array([len(rr) for rr, _ in pixels])
+        if not counts.any():
+            continue
+        rr = np.concatenate([p[0] for p in pixels])
+        cc = np.concatenate([p[1] for p in pixels])
+        labels = np.repeat(np.arange(len(idx)), counts)
+        y0, x0 = rr.min(), cc.min()
+        window = image[lead + (slice(y0, rr.max() + 1), slice(x0, cc.max() + 1))]
+        values = np.asarray(window)[rr - y0, cc - x0].astype(float)
+
+        hit = counts > 0
+        total = np.bincount(labels, weights=values, minlength=len(idx))
+        mean = total / np.maximum(counts, 1)
+        sq_dev = np.bincount(
+            labels, weights=(values - mean[labels]) ** 2, minlength=len(idx)
+        )
+        # pixels are grouped by label, so min/max reduce over contiguous runs
+        starts = (np.cumsum(counts) - counts)[hit]
+        stats["Mean"][idx[hit]] = mean[hit]
+        stats["Sum"][idx[hit]] = total[hit]
+        stats["Min"][idx[hit]] = np.minimum.reduceat(values, starts)
+        stats["Max"][idx[hit]] = np.maximum.reduceat(values, starts)
+        stats["Std"][idx[hit]] = np.sqrt(sq_dev[hit] / counts[hit])
+    return stats
+
+
+def _shape_hash(vertices: np.ndarray, shape_type: str) -> int:
+    vertices = np.ascontiguousarray(vertices, dtype=float)
+    return hash((shape_type, vertices.shape, vertices.tobytes()))
+
+
+class MeasurementCache:
+    """Measurements of a Shapes layer, one row per shape index.
+
+    Each row is stored with a hash of its shape type and vertices. On `update`
+    the new hashes are compared with the cached ones from both ends, so only
+    the span of shapes that was added, moved or deleted is re-measured.
+    """
+
+    def __init__(
+        self, px_size: np.ndarray, units: str = "px", image: np.ndarray | None = None
+    ) -> None:
+        self.px_size = px_size
+        self.units = units
+        self.image = image
+        self.columns = list(measure_shapes([], [], px_size, units, image))
+        self.hashes: list[int] = []
+        self.rows: list[list] = []
+
+    def clear(self) -> None:
+        self.hashes = []
+        self.rows = []
+
+    def update(
+        self, data: list[np.ndarray], shape_types: list[str]
+    ) -> tuple[int, int, list[list]]:
+        """Sync the cache with the layer and return the patch that was applied.
+
+        The patch is `(start, n_removed, new_rows)`: cached rows
+        `start:start + n_removed` were replaced by `new_rows`.
+        """
+        hashes = [_shape_hash(v, t) for v, t in zip(data, shape_types)]
+        old = self.hashes
+        start = 0
+        limit = min(len(old), len(hashes))
+        while start < limit and old[start] == hashes[start]:
+            start += 1
+        end_old, end_new = len(old), len(hashes)
+        while (
+            end_old > start
+            and end_new > start
+            and old[end_old - 1] == hashes[end_new - 1]
+        ):
+            end_old -= 1
+            end_new -= 1
+
+        table = measure_shapes(
+            list(data[start:end_new]),
+            list(shape_types[start:end_new]),
+            self.px_size,
+            self.units,
+            self.image,
+        )
+        new_rows = [list(row) for row in zip(*table.values())]
+        self.rows[start:end_old] = new_rows
+        self.hashes = hashes
+        return start, end_old - start, new_rows
+
+
+def box_overlaps(boxes: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Pairs `(i, j)`, `i < j`, of overlapping (y0, x0, y1, x1) boxes.
+
+    Sort and sweep: boxes are sorted by x0, so the boxes whose x-range can
+    overlap box k are the following ones up to the first starting after its
+    x1 (found with `np.searchsorted`). Only those candidates are checked in y,
+    which takes O(n log n + candidates) instead of comparing all pairs.
+    """
+    n = len(boxes)
+    order = np.argsort(boxes[:, 1], kind="stable")
+    sorted_boxes = boxes[order]
+    starts = np.arange(1, n + 1)
+    ends = np.searchsorted(sorted_boxes[:, 1], sorted_boxes[:, 3], side="right")
+    lengths = np.maximum(ends - starts, 0)
+    i = np.repeat(np.arange(n), lengths)
+    offsets = np.cumsum(lengths) - lengths
+    j = np.arange(lengths.sum()) - np.repeat(offsets - starts, lengths)
+    keep = (sorted_boxes[i, 0] <= sorted_boxes[j, 2]) & (
+        sorted_boxes[j, 0] <= sorted_boxes[i, 2]
+    )
+    i, j = order[i[keep]], order[j[keep]]
+    return np.minimum(i, j), np.maximum(i, j)
+
+
+class ShapeIndex:
+    """Spatial index of the shapes of a Shapes layer, for neighbour queries.
+
+    The centroid (mean vertex) and bounding box of each shape are kept in
+    scaled units, one row per shape index, and are patched with the same
+    `(start, n_removed, ...)` spans as `MeasurementCache.update` reports. On
+    `neighbours` a KD-tree of the centroids and a sort-and-sweep of the boxes
+    are built per plane, so all columns are computed in O(n log n) rather
+    than by comparing every pair of shapes. Shapes on different planes (their
+    leading, non-YX coordinates) are never neighbours.
+    """
+
+    def __init__(self, px_size: np.ndarray, radius: float, units: str = "px") -> None:
+        self.scale = np.asarray(px_size, dtype=float)[-2:]
+        self.radius = radius
+        self.units = units
+        self.columns = [
+            f"Nearest ({units})",
+            f"Neighbours (<{radius:g} {units})",
+            "Box overlaps",
+        ]
+        self.clear()
+
+    def clear(self) -> None:
+        self.planes: list[tuple] = []
+        self.centroids = np.empty((0, 2))
+        self.boxes = np.empty((0, 4))
+
+    def update(self, start: int, n_removed: int, data: list[np.ndarray]) -> None:
+        """Replace shapes `start:start + n_removed` by the shapes in `data`."""
+        end = start + n_removed
+        self.planes[start:end] = [
+            tuple(np.round(np.asarray(v)[0, :-2]).astype(int).tolist()) for v in data
+        ]
+        centroids, boxes = np.empty((0, 2)), np.empty((0, 4))
+        if len(data):
+            verts, counts = _pad_vertices(list(data))
+            verts = verts * self.scale
+            # the padding repeats the last vertex: no change to the boxes,
+            # but it is taken out of the sums for the centroids
+            boxes = np.concatenate([verts.min(axis=1), verts.max(axis=1)], axis=1)
+            padding = (verts.shape[1] - counts)[:, None] * verts[:, -1]
+            centroids = (verts.sum(axis=1) - padding) / counts[:, None]
+        self.centroids = np.concatenate(
+            [self.centroids[:start], centroids, self.centroids[end:]]
+        )
+        self.boxes = np.concatenate([self.boxes[:start], boxes, self.boxes[end:]])
+
+    def neighbours(self) -> dict[str, np.ndarray]:
+        """Distance to the nearest centroid, number of centroids within
+        `radius` and number of overlapping bounding boxes, per shape."""
+        from scipy.spatial import cKDTree
+
+        n = len(self.planes)
+        nearest = np.full(n, np.nan)
+        within = np.zeros(n)
+        overlaps = np.zeros(n)
+        planes = {}
+        for i, plane in enumerate(self.planes):
+            planes.setdefault(plane, []).append(i)
+        for idx in planes.values():
+            idx = np.asarray(idx)
+            if len(idx) < 2:
+                continue
+            centroids = self.centroids[idx]
+            tree = cKDTree(centroids)
+            distances, _ = tree.query(centroids, k=2)
+            nearest[idx] = distances[:, 1]
+            # each centroid also finds itself
+            within[idx] = (
+                tree.query_ball_point(centroids, self.radius, return_length=True) - 1
+            )
+            i, j = box_overlaps(self.boxes[idx])
+            overlaps[idx] = np.bincount(i, minlength=len(idx)) + np.bincount(
+                j, minlength=len(idx)
+            )
+        return dict(zip(self.columns, (nearest, within, overlaps)))
+
+
+class ResultStore:
+    """Typed, append-only columnar store for measurement results.
+
+    "Shape" (and "Image", for batch runs) are fixed-width string columns,
+    every other column is float64 at full precision with NaN where a value
+    does not apply. Capacity grows geometrically, so appending rows does not
+    reallocate on every call.
+    """
+
+    TEXT_COLUMNS = {"Image": "U256", "Shape": "U16"}
+
+    def __init__(self, columns: list[str], capacity: int = 256) -> None:
+        self._arrays = {
+            column: np.empty(capacity, dtype=self.TEXT_COLUMNS.get(column, float))
+            for column in columns
+        }
+        self._size = 0
+        self._lock = threading.Lock()
+        # snapshots are numbered, see `export_async`
+        self._exports = 0
+        self._written = {}
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def columns(self) -> list[str]:
+        return list(self._arrays)
+
+    def _reserve(self, n: int) -> None:
+        capacity = len(next(iter(self._arrays.values())))
+        if n <= capacity:
+            return
+        capacity = max(n, 2 * capacity)
+        for column, array in self._arrays.items():
+            grown = np.empty(capacity, dtype=array.dtype)
+            grown[: self._size] = array[: self._size]
+            self._arrays[column] = grown
+
+    def extend(self, table: dict[str, np.ndarray]) -> None:
+        """Append the rows of a columnar table, e.g. from `measure_shapes`."""
+        n = len(next(iter(table.values())))
+        self._reserve(self._size + n)
+        for column, array in self._arrays.items():
+            array[self._size : self._size + n] = table[column]
+        self._size += n
+
+    def to_dict(self) -> dict[str, np.ndarray]:
+        """Return views of the filled part of each column."""
+        return {column: array[: self._size] for column, array in self._arrays.items()}
+
+    def iter_chunks(self, chunk_size: int = 65536) -> Iterator[dict[str, np.ndarray]]:
+        columns = self.to_dict()
+        for start in range(0, self._size, chunk_size):
+            yield {k: v[start : start + chunk_size] for k, v in columns.items()}
+
+    def to_csv(self, path: str | Path, chunk_size: int = 65536) -> None:
+        """Write the results to CSV chunk by chunk; NaN is written as empty."""
+        with self._lock, open(path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(self.columns)
+            for chunk in self.iter_chunks(chunk_size):
+                cells = [
+                    (
+                        values
+                        if values.dtype.kind == "U"
+                        else np.where(np.isnan(values), "", values.astype(str))
+                    )
+                    for values in chunk.values()
+                ]
+                writer.writerows(zip(*cells))
+
+    def to_parquet(self, path: str | Path, chunk_size: int = 65536) -> None:
+        """Write the results to Parquet, one row group per chunk (needs pyarrow)."""
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError as err:
+            raise ImportError("Parquet export requires pyarrow") from err
+
+        def to_arrow(chunk):
+            return pa.table(
+                {k: pa.array(v, from_pandas=True) for k, v in chunk.items()}
+            )
+
+        with self._lock:
+            chunks = self.iter_chunks(chunk_size)
+            first = next(chunks, None)
+            if first is None:
+                first = {k: v[:0] for k, v in self._arrays.items()}
+            first = to_arrow(first)
+            with pq.ParquetWriter(path, first.schema) as writer:
+                writer.write_table(first)
+                for chunk in chunks:
+                    writer.write_table(to_arrow(chunk))
+
+    def export(self, path: str | Path, chunk_size: int = 65536) -> None:
+        """Write to Parquet if `path` ends in .parquet, otherwise to CSV."""
+        if Path(path).suffix == ".parquet":
+            self.to_parquet(path, chunk_size)
+        else:
+            self.to_csv(path, chunk_size)
+
+    def export_async(self, path: str | Path) -> threading.Thread:
+        """Export a snapshot of the current rows in a background thread.
+
+        The lock does not hand over to the threads in order, so a snapshot
+        older than the last one written to `path` is skipped rather than
+        overwriting newer rows.
+        """
+        self._exports += 1
+        number, key = self._exports, str(Path(path).resolve())
+        snapshot = ResultStore(self.columns, capacity=max(self._size, 1))
+        snapshot.extend(self.to_dict())
+
+        def write():
+            with self._lock:
+                if self._written.get(key, 0) > number:
+                    return
+                snapshot.export(path)
+                self._written[key] = number
+
+        thread = threading.Thread(target=write, daemon=True)
+        thread.start()
+        return thread
+
+
+def lut_format(path: str | Path) -> str:
+    """Format of an ImageJ .lut file from its size and header.
+
+    "raw" is 768 bytes of red, green and blue values, "nih" is an NIH Image
+    color table with a 32 byte "ICOL" header, anything else is read as text.
+    """
+    path = Path(path)
+    if path.stat().st_size == 768:
+        return "raw"
+    with open(path, "rb") as f:
+        if f.read(4) == b"ICOL":
+            return "nih"
+    return "text"
+
+
+def read_lut(path: str | Path) -> np.ndarray:
+    """Read an ImageJ .lut file as a (256, 3) RGB array in [0, 1]."""
+    fmt = lut_format(path)
+    if fmt == "raw":
+        return np.fromfile(path, np.uint8).reshape(3, 256).T / 255
+    if fmt == "nih":
+        # the number of colors is a big-endian int16 after magic and version
+        data = np.fromfile(path, np.uint8)
+        n_colors = int(data[6]) << 8 | int(data[7])
+        return data[32 : 32 + 3 * n_colors].reshape(3, n_colors).T / 255
+    # text tables have 3 (RGB) or 4 (index, RGB) columns and an optional header
+    with open(path) as f:
+        first = f.readline()
+    skiprows = int(any(c.isalpha() for c in first))
+    lut = np.loadtxt(path, skiprows=skiprows, ndmin=2)
+    if lut.shape[1] not in (3, 4):
+        raise ValueError(f"{path} has {lut.shape[1]} columns, not 3 or 4")
+    return lut[:, -3:] / 255
+
+
+def lut_library(
+    folder: str | Path, cache_dir: str | Path | None = None, workers: int = 8
+) -> dict:
+    """All ImageJ LUTs in `folder`, as {name: (256, 3) array}, sorted by name.
+
+    The LUTs are parsed in a thread pool and stored in an .npz file in
+    `cache_dir` (by default ~/.cache/napari_scripts); only files that are new
+    or changed since (by size and mtime) are parsed again. Files that cannot
+    be parsed are skipped.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    folder = Path(folder).resolve()
+    cache_dir = Path(cache_dir) if cache_dir is not None else _default_cache_dir()
+    sidecar = _sidecar_path(folder, cache_dir, ".luts.npz")
+    keys = {}
+    for path in folder.glob("*.lut"):
+        stat = path.stat()
+        keys[path.stem] = [path.name, stat.st_size, stat.st_mtime]
+
+    # the cache holds all LUTs concatenated, with the key and row count of each
+    luts, cached_keys = {}, {}
+    try:
+        with np.load(sidecar) as cached:
+            cached_keys = json.loads(str(cached["keys"]))
+            names = list(cached_keys)
+            rows = np.split(cached["luts"], np.cumsum(cached["lengths"])[:-1])
+            luts = {name: lut for name, lut in zip(names, rows) if name in keys}
+    except (OSError, ValueError, KeyError):
+        pass
+    stale = [name for name in keys if cached_keys.get(name) != keys[name]]
+
+    def parse(name):
+        try:
+            return read_lut(folder / keys[name][0])
+        except (OSError, ValueError):
+            print(f"Could not read {keys[name][0]}")
+            return np.empty((0, 3))
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        luts.update(zip(stale, pool.map(parse, stale)))
+    if stale or set(cached_keys) != set(keys):
+        luts = {name: luts[name] for name in keys}
+        try:
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            with open(sidecar, "wb") as f:
+                np.savez(
+                    f,
+                    keys=json.dumps(keys),
+                    luts=np.concatenate([np.empty((0, 3)), *luts.values()]),
+                    lengths=np.array([len(lut) for lut in luts.values()], dtype=int),
+                )
+        except OSError:
+            pass  # a read-only cache only costs the speed-up
+    # files that could not be parsed are cached as empty tables
+    luts = {name: lut for name, lut in luts.items() if len(lut)}
+    return dict(sorted(luts.items(), key=lambda item: item[0].lower()))
+
+
+SCENE_INDEX_VERSION = 1
+
+
+def _default_cache_dir() -> Path:
+    return Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")) / (
+        "napari_scripts"
+    )
+
+
+def _sidecar_path(path: Path, cache_dir: Path, suffix: str) -> Path:
+    digest = hashlib.sha1(str(path).encode()).hexdigest()[:16]
+    return cache_dir / f"{path.stem}-{digest}{suffix}"
+
+
+def _file_key(path: Path) -> dict:
+    stat = path.stat()
+    return {
+        "path": str(path),
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "version": SCENE_INDEX_VERSION,
+    }
+
+
+def read_scene_metadata(img) -> list[dict]:
+    """Shape, dtype, dims, pixel sizes and channel names of every scene.
+
+    `img` is an `aicsimageio.AICSImage`; only metadata is read, no pixel data.
+    """
+    scenes = []
+    for scene in img.scenes:
+        img.set_scene(scene)
+        sizes = img.physical_pixel_sizes
+        scenes.append(
+            {
+                "name": scene,
+                "shape": list(img.shape),
+                "dtype": str(img.dtype),
+                "dims": img.dims.order,
+                "physical_pixel_sizes": [sizes.Z, sizes.Y, sizes.X],
+                "channel_names": [str(c) for c in img.channel_names or []],
+            }
+        )
+    return scenes
+
+
+def scene_index(
+    path: str | Path, cache_dir: str | Path | None = None, **reader_kwargs
+) -> list[dict]:
+    """Metadata of every scene of an image file (see `read_scene_metadata`).
+
+    The index is stored as a small JSON sidecar in `cache_dir` (by default
+    ~/.cache/napari_scripts), keyed by the file's path, size and mtime, so
+    reopening an unchanged file does not touch the reader at all.
+    """
+    path = Path(path).resolve()
+    cache_dir = Path(cache_dir) if cache_dir is not None else _default_cache_dir()
+    sidecar = _sidecar_path(path, cache_dir, ".scenes.json")
+    key = {
+        **_file_key(path),
+        "reader_kwargs": {k: repr(v) for k, v in reader_kwargs.items()},
+    }
+    try:
+        cached = json.loads(sidecar.read_text())
+        if cached["key"] == key:
+            return cached["scenes"]
+    except (OSError, ValueError, KeyError):
+        pass
+
+    from aicsimageio import AICSImage
+
+    scenes = read_scene_metadata(AICSImage(path, **reader_kwargs))
+    try:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        sidecar.write_text(json.dumps({"key": key, "scenes": scenes}))
+    except OSError:
+        pass  # a read-only cache only costs the speed-up
+    return scenes
+
+
+def describe_scene(entry: dict) -> str:
+    """One-line summary of a scene index entry, e.g. "Pos1  TZYX 5×12×512×512 uint16"."""
+    kept = [(d, n) for d, n in zip(entry["dims"], entry["shape"]) if n > 1]
+    dims = "".join(d for d, _ in kept)
+    shape = "×".join(str(n) for _, n in kept)
+    return f"{entry['name']}  {dims} {shape} {entry['dtype']}"
+
+
+def squeeze_dims(dims: str, shape) -> str:
+    """`dims` without its singleton axes, always keeping Y and X."""
+    return "".join(d for d, n in zip(dims, shape) if n > 1 or d in "YX")
+
+
+def scene_scale(dims: str, physical_pixel_sizes) -> list:
+    """Scale of each of `dims` from the [Z, Y, X] pixel sizes (1 if unknown)."""
+    sizes = dict(zip("ZYX", physical_pixel_sizes))
+    return [sizes.get(d) or 1 for d in dims]
+
+
+def neighbour_steps(step, shape, axes, n: int = 2) -> list:
+    """Indices of the `n` planes before and after `step` along each of `axes`.
+
+    Nearest planes come first, alternating forward and backward; indices
+    outside of `shape` are skipped.
+    """
+    steps = []
+    for distance in range(1, n + 1):
+        for axis in axes:
+            for i in (step[axis] + distance, step[axis] - distance):
+                if 0 <= i < shape[axis]:
+                    steps.append(tuple(step[:axis]) + (i,) + tuple(step[axis + 1 :]))
+    return steps
+
+
+_thread_images = threading.local()
+
+
+def _thread_image(path: Path, reader_kwargs: dict):
+    # one AICSImage per thread and file, as set_scene mutates the reader
+    from aicsimageio import AICSImage
+
+    key = (str(path), repr(sorted(reader_kwargs.items())))
+    images = _thread_images.__dict__.setdefault("images", {})
+    if key not in images:
+        images[key] = AICSImage(path, **reader_kwargs)
+    return images[key]
+
+
+def scene_thumbnail(
+    path: str | Path,
+    scene: str,
+    size: int = 64,
+    projection: str = "middle",
+    cache_dir: str | Path | None = None,
+    **reader_kwargs,
+) -> np.ndarray:
+    """Low-resolution uint8 thumbnail of the first channel/timepoint of a scene.
+
+    `projection` is "middle" (middle Z plane) or "max" (max projection over Z).
+    Only the needed planes are read, through the reader's dask data, and the
+    thumbnail is cached on disk (keyed like `scene_index`). For "middle" the
+    reader is chunked per YX plane unless `chunk_dims` is given, as by default
+    LIF data are chunked (and read) per Z-stack.
+    """
+    if projection == "middle":
+        reader_kwargs.setdefault("chunk_dims", "YX")
+    path = Path(path).resolve()
+    cache_dir = Path(cache_dir) if cache_dir is not None else _default_cache_dir()
+    key = json.dumps(
+        [_file_key(path), reader_kwargs, scene, size, projection], default=repr
+    )
+    cached = _sidecar_path(path, cache_dir, ".thumbs") / (
+        hashlib.sha1(key.encode()).hexdigest()[:16] + ".npy"
+    )
+    try:
+        return np.load(cached)
+    except (OSError, ValueError):
+        pass
+
+    img = _thread_image(path, reader_kwargs)
+    img.set_scene(scene)
+    # first index of every axis other than Z, Y and X
+    first = {d: 0 for d in img.dims.order if d not in "ZYX"}
+    stack = img.get_image_dask_data("ZYX", **first)
+    step = max(1, int(np.ceil(max(stack.shape[-2:]) / size)))
+    if projection == "max":
+        plane = stack[:, ::step, ::step].max(axis=0)
+    else:
+        plane = stack[stack.shape[0] // 2, ::step, ::step]
+    plane = np.asarray(plane, dtype=float)
+    low, high = np.percentile(plane, (1, 99.8))
+    thumbnail = np.clip((plane - low) / max(high - low, 1e-12) * 255, 0, 255)
+    thumbnail = np.ascontiguousarray(thumbnail.astype(np.uint8))
+    try:
+        cached.parent.mkdir(parents=True, exist_ok=True)
+        np.save(cached, thumbnail)
+    except OSError:
+        pass
+    return thumbnail
+
+
+@lru_cache(maxsize=16)
+def _load_scene(path, mtime, scene, dims, reader_kwargs):
+    from aicsimageio import AICSImage
+
+    img = AICSImage(path, **dict(reader_kwargs))
+    img.set_scene(scene)
+    return img.get_image_dask_data(dims)
+
+
+def load_scene(path: str | Path, scene: str, dims: str, **reader_kwargs):
+    """Lazy dask data of one scene, in the `dims` order of the reader.
+
+    Each scene gets its own reader, so scenes never share the mutable
+    `set_scene` state, and the 16 most recently loaded scenes are cached.
+    """
+    path = Path(path).resolve()
+    return _load_scene(
+        str(path),
+        path.stat().st_mtime,
+        scene,
+        dims,
+        tuple(sorted(reader_kwargs.items())),
+    )
+
+
+def build_pyramid(data, min_size: int = 1024, factor: int = 2) -> list:
+    """Lazy multiscale pyramid of a dask array, coarsening only Y and X.
+
+    Each level is the block mean of the previous one, until the larger of Y
+    and X is at most `min_size`. Returns the levels, full resolution first.
+    """
+    import dask.array as da
+
+    levels = [data]
+    while max(levels[-1].shape[-2:]) > min_size:
+        prev = levels[-1]
+        axes = {prev.ndim - 2: factor, prev.ndim - 1: factor}
+        level = da.coarsen(np.mean, prev, axes, trim_excess=True)
+        levels.append(level.astype(prev.dtype))
+    return levels
+
+
+def persist_pyramid(levels: list, store: str | Path, factor: int = 2) -> list:
+    """Write pyramid levels 1.. to a local Zarr group and read them back lazily.
+
+    Each level is computed from the stored previous level, so the full
+    resolution data (level 0, returned as is) are read only once. A group
+    that was completely written before is reused without recomputation.
+    """
+    import dask.array as da
+    import zarr
+
+    store = str(store)
+    root = zarr.open_group(store, mode="a")
+    if root.attrs.get("levels") == len(levels):
+        return [levels[0]] + [
+            da.from_zarr(store, component=str(i)) for i in range(1, len(levels))
+        ]
+    stored = [levels[0]]
+    for i in range(1, len(levels)):
+        prev = stored[-1]
+        axes = {prev.ndim - 2: factor, prev.ndim - 1: factor}
+        level = da.coarsen(np.mean, prev, axes, trim_excess=True).astype(prev.dtype)
+        # one chunk per YX plane, at most 1024 x 1024 pixels
+        chunks = (1,) * (level.ndim - 2) + (1024, 1024)
+        level.rechunk(chunks).to_zarr(store, component=str(i), overwrite=True)
+        stored.append(da.from_zarr(store, component=str(i)))
+    root.attrs["levels"] = len(levels)
+    return stored
+
+
+def scene_pyramid(
+    path: str | Path,
+    scene: str,
+    dims: str,
+    persist: bool = False,
+    min_size: int = 1024,
+    cache_dir: str | Path | None = None,
+    **reader_kwargs,
+) -> list:
+    """Multiscale levels of a scene (see `load_scene` and `build_pyramid`).
+
+    With `persist=True`, the lower resolution levels are written once to a
+    Zarr cache next to the scene index and read from there afterwards.
+    """
+    levels = build_pyramid(
+        load_scene(path, scene, dims, **reader_kwargs), min_size=min_size
+    )
+    if not persist or len(levels) == 1:
+        return levels
+    path = Path(path).resolve()
+    cache_dir = Path(cache_dir) if cache_dir is not None else _default_cache_dir()
+    key = json.dumps([_file_key(path), reader_kwargs, scene, dims, min_size])
+    store = _sidecar_path(path, cache_dir, ".pyramids") / (
+        hashlib.sha1(key.encode()).hexdigest()[:16] + ".zarr"
+    )
+    store.parent.mkdir(parents=True, exist_ok=True)
+    return persist_pyramid(levels, store)
+
+
+class _CachedPlanes:
+    # array-like for `da.from_array`: each chunk is one YX plane of `data`,
+    # read through the PlaneCache
+    def __init__(self, cache: PlaneCache, data) -> None:
+        self.cache = cache
+        self.data = data
+        self.shape = data.shape
+        self.dtype = data.dtype
+        self.ndim = data.ndim
+
+    def __getitem__(self, key):
+        key = key if isinstance(key, tuple) else (key,)
+        key = key + (slice(None),) * (self.ndim - len(key))
+        # the leading axes must select a single plane: an integer (dropping
+        # the axis) or a slice of length one (keeping it)
+        index, kept = [], []
+        for k, n in zip(key[: self.ndim - 2], self.shape):
+            if isinstance(k, (int, np.integer)):
+                index.append(int(k) % n)
+            elif isinstance(k, slice) and len(range(*k.indices(n))) == 1:
+                index.append(k.indices(n)[0])
+                kept.append(None)
+            else:
+                return np.asarray(self.data[key])
+        plane = self.cache.plane(self, tuple(index))
+        return plane[tuple(kept) + key[self.ndim - 2 :]]
+
+
+class PlaneCache:
+    """Bounded LRU cache of the YX planes of lazy arrays, safe to share by threads.
+
+    `wrap(data)` returns a dask array, chunked per YX plane, whose planes are
+    read through the cache: computing a plane (for display, or ahead of time
+    in a prefetch thread) stores it, and the least recently used planes are
+    evicted once they take more than `max_bytes`.
+    """
+
+    def __init__(self, max_bytes: int = 2**30) -> None:
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._planes = OrderedDict()
+        self._sources = {}
+        self._lock = threading.Lock()
+
+    def wrap(self, data):
+        import dask.array as da
+
+        source = _CachedPlanes(self, data)
+        name = f"plane-cache-{id(source):x}"
+        self._sources[name] = source
+        chunks = (1,) * (data.ndim - 2) + tuple(data.shape[-2:])
+        return da.from_array(
+            source,
+            chunks=chunks,
+            name=name,
+            lock=False,
+            meta=np.empty((0,) * data.ndim, dtype=data.dtype),
+        )
+
+    def plane(self, source: _CachedPlanes, index: tuple) -> np.ndarray:
+        key = (source, index)
+        with self._lock:
+            if key in self._planes:
+                self._planes.move_to_end(key)
+                return self._planes[key]
+        # read outside the lock, so other planes can be served meanwhile
+        plane = source.data[index]
+        if hasattr(plane, "compute"):
+            plane = plane.compute(scheduler="synchronous")
+        plane = np.asarray(plane)
+        with self._lock:
+            if key not in self._planes:
+                self._planes[key] = plane
+                self.nbytes += plane.nbytes
+            while self.nbytes > self.max_bytes and len(self._planes) > 1:
+                _, evicted = self._planes.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+        return plane
+
+    def release(self, wrapped) -> None:
+        """Drop the cached planes of an array returned by `wrap`."""
+        source = self._sources.pop(wrapped.name, None)
+        with self._lock:
+            for key in [key for key in self._planes if key[0] is source]:
+                self.nbytes -= self._planes.pop(key).nbytes
+
+
+class LatencyRecorder:
+    """Opt-in timings of the interactive callbacks, in bounded ring buffers.
+
+    Every record has the wall time of a callback and, where known, its
+    compute and draw time (in seconds) and the queue depth: how many requests
+    were waiting or running when it was made. Only the last `maxlen` records
+    of each callback are kept. Nothing is recorded until `enable()`.
+    """
+
+    FIELDS = ("wall", "compute", "draw", "queue")
+
+    def __init__(self, maxlen: int = 1000) -> None:
+        self.maxlen = maxlen
+        self.enabled = False
+        self.records = {}
+
+    def enable(self, maxlen: int | None = None) -> None:
+        if maxlen is not None:
+            self.maxlen = maxlen
+            self.records.clear()
+        self.enabled = True
+
+    def disable(self) -> None:
+        self.enabled = False
+
+    def record(
+        self,
+        name: str,
+        wall: float,
+        compute: float = np.nan,
+        draw: float = np.nan,
+        queue: int = 0,
+    ) -> None:
+        if not self.enabled:
+            return
+        if name not in self.records:
+            from collections import deque
+
+            self.records.setdefault(name, deque(maxlen=self.maxlen))
+        self.records[name].append((wall, compute, draw, queue))
+
+    @contextmanager
+    def timed(self, name: str, queue: int = 0) -> Iterator[None]:
+        """Record the wall time of the body as a `name` callback."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start, queue=queue)
+
+    def summary(self, percentiles=(50, 90, 99)) -> dict:
+        """Count and percentiles of each field per callback, times in ms."""
+        summary = {}
+        for name, records in list(self.records.items()):
+            values = np.array(records, dtype=float).reshape(-1, 4)
+            values[:, :3] *= 1000
+            stats = {"n": len(values)}
+            for field, column in zip(self.FIELDS, values.T):
+                column = column[~np.isnan(column)]
+                for q, value in zip(
+                    percentiles,
+                    np.percentile(column, percentiles) if column.size else [],
+                ):
+                    stats[f"{field} p{q}"] = float(value)
+            summary[name] = stats
+        return summary
+
+    def dump(self, path: str | Path) -> None:
+        """Write the summary and the raw records as JSON."""
+        raw = {
+            name: [
+                {f: None if np.isnan(v) else v for f, v in zip(self.FIELDS, r)}
+                for r in records
+            ]
+            for name, records in list(self.records.items())
+        }
+        Path(path).write_text(
+            json.dumps({"summary": self.summary(), "records": raw}, indent=1)
+        )
+
+
+# shared by the widgets, enabled by the latency widget
+latency = LatencyRecorder()